@@ -6,132 +6,809 @@ Connects to separate PrivacyIDEA service for authentication
 
 import radiusd
 import requests
+import hashlib
+import hmac
 import json
 import os
+import socket
 import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import make_dataclass
+from types import MappingProxyType
 from urllib.parse import urljoin
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from privacyidea_async import AsyncValidator, ConnectFailed, EngineBusy
+from circuit_breaker import CircuitBreaker
+from radius_attrs import attribute_extractor
+from radius_metrics import Metrics
 
-# Configuration from environment
-PRIVACYIDEA_URL = os.environ.get('PRIVACYIDEA_URL', 'https://localhost')
-VALIDATE_SSL = os.environ.get('PRIVACYIDEA_VALIDATE_SSL', 'false').lower() == 'true'
-REALM = os.environ.get('PRIVACYIDEA_REALM', 'default')
-TIMEOUT = int(os.environ.get('PRIVACYIDEA_TIMEOUT', '30'))
-DEBUG = os.environ.get('PRIVACYIDEA_DEBUG', 'false').lower() == 'true'
+# Module settings as (config item, default). Each item is read from the
+# module's config section, falling back to the PRIVACYIDEA_<ITEM>
+# environment variable and then to the default. The type of the default
+# decides how the value is parsed.
+SETTINGS = (
+    # One or more PrivacyIDEA nodes, separated by commas or spaces
+    ('privacyidea_url', 'https://localhost'),
+    ('validate_ssl', False),
+    ('realm', 'default'),
+    ('timeout', 30.0),
+    ('debug', False),
+
+    # Connection pool
+    ('pool_size', 10),
+    ('pool_block', False),
+    ('pool_idle_timeout', 300.0),
+    ('keepalive', True),
+    ('keepalive_idle', 60),
+    ('keepalive_interval', 10),
+    ('keepalive_count', 3),
+
+    # Startup: connections opened per node by the background warm-up, and
+    # how long early requests wait for the warm-up before going ahead
+    ('warmup_connections', 4),
+    ('ready_wait', 1.0),
+
+    # Endpoint selection across several PrivacyIDEA nodes: weight of the
+    # newest sample in the latency average, and the back-off a failing
+    # node is taken out of rotation for (doubling up to the maximum)
+    ('ewma_alpha', 0.3),
+    ('endpoint_backoff', 5.0),
+    ('endpoint_max_backoff', 120.0),
+
+    # Request engine: 'sync' blocks the worker thread on the pooled
+    # session, 'async' hands requests to a shared background event loop
+    ('engine', 'sync'),
+    ('max_inflight', 64),
+    ('max_queue', 256),
+
+    # Positive result cache, off by default
+    ('cache', False),
+    ('cache_ttl', 10.0),
+    ('cache_size', 10000),
+    ('cache_allow_otp', False),
+
+    # Circuit breaker, fails requests fast while PrivacyIDEA is unhealthy
+    ('breaker', True),
+    ('breaker_window', 30.0),
+    ('breaker_min_requests', 20),
+    ('breaker_error_rate', 0.5),
+    ('breaker_timeout_rate', 0.3),
+    ('breaker_open_interval', 10.0),
+
+    # Share one upstream request between concurrent identical requests,
+    # off by default: every waiter gets the first caller's answer, even a
+    # separate login that is not a retransmission
+    ('coalesce', False),
+
+    # Optional Prometheus metrics listener, disabled when no port is set
+    ('metrics_address', '127.0.0.1'),
+    ('metrics_port', 0)
+)
+
+# Token types whose password stays valid between requests. Anything else
+# is treated as a one-time password and never cached unless
+# cache_allow_otp is set.
+STATIC_TOKEN_TYPES = ('spass', 'pw', 'passthru')
+
+Settings = make_dataclass(
+    'Settings',
+    [name for name, _ in SETTINGS] + [
+        # Derived once at instantiation
+        'endpoints',
+        'headers',
+        'body_template'
+    ],
+    frozen=True
+)
+
+# Request attributes used by authenticate()
+REQUEST_ATTRS = attribute_extractor({
+    'User-Name': None,
+    'User-Password': None,
+    'Client-IP-Address': None
+})
+
+# Settings, loaded in instantiate()
+settings = None
+
+# Pooled HTTP session, created in instantiate() and closed in detach()
+session = None
+session_lock = threading.Lock()
+session_last_used = 0.0
+
+# Endpoint selection, created in instantiate()
+balancer = None
+
+# Startup state, replaced on every instantiate()
+readiness = None
+
+# Async engine, only set when the engine setting is 'async'
+engine = None
+
+# Result cache, only set when the cache is enabled
+cache = None
+
+# Circuit breaker, only set when the breaker is enabled
+breaker = None
+
+# Request coalescing, only set when coalescing is enabled
+coalescer = None
+
+# Random per-process salt for credential keys
+KEY_SALT = os.urandom(32)
+
+MODULE_NAME = 'privacyidea_client'
+
+METRICS = Metrics(MODULE_NAME)
 
 def log(level, msg):
     """Log messages to FreeRADIUS log"""
-    radiusd.radlog(level, f"privacyidea_client: {msg}")
+    radiusd.radlog(level, f"{MODULE_NAME}: {msg}")
+
+def load_settings(config):
+    """Build the immutable settings for this module instance"""
+    values = {}
+    for name, default in SETTINGS:
+        value = config.get(name)
+        if value is None or value == '':
+            env = name.upper()
+            if not env.startswith('PRIVACYIDEA_'):
+                env = f"PRIVACYIDEA_{env}"
+            value = os.environ.get(env)
+        if value is None or value == '':
+            values[name] = default
+        elif isinstance(default, bool):
+            values[name] = str(value).lower() in ('true', 'yes', 'on', '1')
+        else:
+            values[name] = type(default)(value)
+
+    values['engine'] = values['engine'].lower()
+    values['endpoints'] = tuple(values['privacyidea_url'].replace(',', ' ').split())
+    if not values['endpoints']:
+        raise ValueError("privacyidea_url lists no endpoints")
+    values['headers'] = MappingProxyType({
+        'Content-Type': 'application/x-www-form-urlencoded',
+        'Accept': 'application/json',
+        'Connection': 'keep-alive'
+    })
+    values['body_template'] = MappingProxyType(
+        {'realm': values['realm']} if values['realm'] else {}
+    )
+    return Settings(**values)
+
+class KeepAliveAdapter(HTTPAdapter):
+    """HTTP adapter enabling TCP keep-alive on pooled connections"""
+
+    def __init__(self, settings, **kwargs):
+        self.settings = settings
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.settings.keepalive:
+            options = list(HTTPConnection.default_socket_options)
+            options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+            # Probe tuning is Linux specific, skip what the platform lacks
+            for name, value in (('TCP_KEEPIDLE', self.settings.keepalive_idle),
+                                ('TCP_KEEPINTVL', self.settings.keepalive_interval),
+                                ('TCP_KEEPCNT', self.settings.keepalive_count)):
+                if hasattr(socket, name):
+                    options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+            kwargs['socket_options'] = options
+        super().init_poolmanager(*args, **kwargs)
+
+def create_session():
+    """Create a session holding a pool of persistent connections"""
+    new_session = requests.Session()
+    adapter = KeepAliveAdapter(
+        settings,
+        pool_connections=len(settings.endpoints),
+        pool_maxsize=settings.pool_size,
+        pool_block=settings.pool_block
+    )
+    new_session.mount('http://', adapter)
+    new_session.mount('https://', adapter)
+    new_session.verify = settings.validate_ssl
+    new_session.headers.update(settings.headers)
+    return new_session
 
-def privacyidea_validate(username, password, client_ip=None):
+def get_session():
+    """
+    Return the pooled session, evicting connections that sat idle for
+    longer than the server is likely to keep them open
+    """
+    global session, session_last_used
+
+    with session_lock:
+        now = time.monotonic()
+        if session is None:
+            session = create_session()
+        elif settings.pool_idle_timeout and now - session_last_used > settings.pool_idle_timeout:
+            if settings.debug:
+                log(radiusd.L_INFO, "Evicting idle PrivacyIDEA connections")
+            for adapter in session.adapters.values():
+                adapter.poolmanager.clear()
+        session_last_used = now
+        return session
+
+def close_session():
+    """Close all pooled connections"""
+    global session
+
+    with session_lock:
+        if session is not None:
+            session.close()
+            session = None
+
+def credentials_key(username, password, client_ip):
+    """
+    Derive a lookup key for a set of credentials
+
+    The key is an HMAC under a random per-process salt, so neither
+    usernames nor passwords are kept in memory in the clear.
+    """
+    material = '\0'.join((username, settings.realm, password, client_ip or ''))
+    return hmac.new(KEY_SALT, material.encode('utf-8'), hashlib.sha256).digest()
+
+class ResultCache:
+    """Short-lived LRU cache of successful authentications"""
+
+    def __init__(self, ttl, size, allow_otp=False):
+        self.ttl = ttl
+        self.size = size
+        self.allow_otp = allow_otp
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return True if the credentials were recently accepted"""
+        now = time.monotonic()
+        with self.lock:
+            expires = self.entries.get(key)
+            if expires is None or expires < now:
+                if expires is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return False
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True
+
+    def put(self, key, token_type):
+        """Remember an accepted authentication if the token type allows it"""
+        if not self.allow_otp and token_type not in STATIC_TOKEN_TYPES:
+            return
+        with self.lock:
+            self.entries[key] = time.monotonic() + self.ttl
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        """Return hit/miss counters and the current number of entries"""
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+class InFlightCall:
+    """An upstream request that concurrent identical requests wait on"""
+
+    __slots__ = ('done', 'result')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = radiusd.RLM_MODULE_FAIL
+
+class Coalescer:
+    """
+    Single-flight request coalescing
+
+    The first thread to ask for a key performs the upstream call, every
+    thread asking for the same key while it is in flight waits for and
+    shares its result. Retransmitted OTPs therefore get one answer
+    instead of one accept followed by replay rejects.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.upstream = 0
+        self.coalesced = 0
+
+    def do(self, key, func, timeout):
+        """Run func() once for all concurrent callers with the same key"""
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None:
+                call = self.calls[key] = InFlightCall()
+                self.upstream += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        if leader:
+            try:
+                call.result = func()
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+            return call.result
+
+        if not call.done.wait(timeout):
+            return None
+        return call.result
+
+    def stats(self):
+        """Return upstream call and saved call counters"""
+        with self.lock:
+            return {
+                'upstream_calls': self.upstream,
+                'saved_calls': self.coalesced,
+                'in_flight': len(self.calls)
+            }
+
+class Endpoint:
+    """One PrivacyIDEA node and what has been observed about it"""
+
+    __slots__ = ('url', 'validate_url', 'health_url', 'ewma', 'inflight',
+                 'failures', 'down_until')
+
+    def __init__(self, url):
+        self.url = url
+        self.validate_url = urljoin(url, '/validate/check')
+        self.health_url = urljoin(url, '/health')
+        # Smoothed response time in seconds, None until the first reply
+        self.ewma = None
+        self.inflight = 0
+        self.failures = 0
+        self.down_until = 0.0
+
+class EndpointBalancer:
+    """
+    Latency-aware selection between PrivacyIDEA nodes
+
+    Nodes in rotation are ranked by an exponentially weighted moving
+    average of their response time, scaled by the requests already in
+    flight to them, so a node that slows down sheds load before it fails
+    outright. A node that cannot be connected to or answers with a server
+    error leaves rotation for a back-off period that doubles with every
+    consecutive failure. When every node is out of rotation they are
+    still tried, soonest due back first, rather than failing blindly.
+    """
+
+    def __init__(self, urls, alpha=0.3, backoff=5.0, max_backoff=120.0):
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.alpha = alpha
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _score(endpoint):
+        # Unmeasured nodes rank first so every node gets a sample
+        ewma = endpoint.ewma or 0.0
+        return (ewma + 0.001) * (endpoint.inflight + 1)
+
+    def candidates(self):
+        """Return the endpoints to try for one request, best first"""
+        now = time.monotonic()
+        with self.lock:
+            healthy = [e for e in self.endpoints if e.down_until <= now]
+            if healthy:
+                return sorted(healthy, key=self._score)
+            return sorted(self.endpoints, key=lambda e: e.down_until)
+
+    def acquire(self, endpoint):
+        """Count a request sent to endpoint"""
+        with self.lock:
+            endpoint.inflight += 1
+
+    def release(self, endpoint):
+        """Count a request to endpoint as finished"""
+        with self.lock:
+            endpoint.inflight -= 1
+
+    def observe(self, endpoint, seconds):
+        """Record the response time of a request that got an answer"""
+        with self.lock:
+            if endpoint.ewma is None:
+                endpoint.ewma = seconds
+            else:
+                endpoint.ewma += self.alpha * (seconds - endpoint.ewma)
+            if endpoint.failures:
+                log(radiusd.L_INFO, f"PrivacyIDEA endpoint {endpoint.url} is back in rotation")
+                endpoint.failures = 0
+                endpoint.down_until = 0.0
+
+    def fail(self, endpoint, reason):
+        """Take endpoint out of rotation for its back-off period"""
+        with self.lock:
+            endpoint.failures += 1
+            backoff = min(self.backoff * 2 ** (endpoint.failures - 1), self.max_backoff)
+            endpoint.down_until = time.monotonic() + backoff
+            log(radiusd.L_WARN, f"PrivacyIDEA endpoint {endpoint.url} out of rotation "
+                f"for {backoff:.0f}s ({reason})")
+
+    def stats(self):
+        """Return latency and health of every endpoint"""
+        now = time.monotonic()
+        with self.lock:
+            return {
+                e.url: {
+                    'ewma_ms': round(e.ewma * 1000, 1) if e.ewma is not None else None,
+                    'inflight': e.inflight,
+                    'failures': e.failures,
+                    'in_rotation': e.down_until <= now
+                }
+                for e in self.endpoints
+            }
+
+class Readiness:
+    """Startup state set by the background warm-up"""
+
+    STARTING = 'starting'
+    READY = 'ready'
+    UNAVAILABLE = 'unavailable'
+
+    def __init__(self):
+        self.state = self.STARTING
+        self.done = threading.Event()
+
+    def set(self, state):
+        """Record the outcome of the warm-up"""
+        self.state = state
+        self.done.set()
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for the warm-up, True once done"""
+        return self.done.wait(timeout)
+
+def is_connect_error(e):
+    """
+    True if a request failed before reaching PrivacyIDEA, so it is safe
+    to send it to another node without risking a used OTP
+    """
+    if isinstance(e, (ConnectFailed, requests.exceptions.ConnectTimeout)):
+        return True
+    reason = getattr(e.args[0], 'reason', None) if e.args else None
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+def warm_connections(url, count, timeout):
+    """
+    Send count concurrent GETs to url through the active engine so its
+    pool holds that many open connections
+    Returns a status code or exception per request
+    """
+    if engine is not None:
+        return engine.warm(url, count, timeout)
+
+    # Release all requests together so each checks out its own connection
+    barrier = threading.Barrier(count)
+
+    def get(_):
+        try:
+            barrier.wait(timeout)
+            return get_session().get(url, timeout=timeout).status_code
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(count, thread_name_prefix=f"{MODULE_NAME}-warmup") as pool:
+        return list(pool.map(get, range(count)))
+
+def warm_up(state):
+    """Health check every node and pre-open its connections"""
+    count = max(1, min(settings.warmup_connections, settings.pool_size))
+    reachable = 0
+    for endpoint in balancer.endpoints:
+        results = warm_connections(endpoint.health_url, count, 5)
+        statuses = [r for r in results if not isinstance(r, Exception)]
+        if not statuses:
+            balancer.fail(endpoint, f"health check failed: {str(results[0])}")
+            continue
+        reachable += 1
+        if 200 in statuses:
+            log(radiusd.L_INFO, f"PrivacyIDEA service at {endpoint.url} is reachable, "
+                f"{len(statuses)} connections warm")
+        else:
+            log(radiusd.L_WARN, f"PrivacyIDEA health check of {endpoint.url} returned: {statuses[0]}")
+
+    state.set(Readiness.READY if reachable else Readiness.UNAVAILABLE)
+    if not reachable:
+        log(radiusd.L_WARN, "No PrivacyIDEA endpoint reachable at startup")
+
+def post_validate(validate_url, data, timeout):
+    """Send the validation request, returns (status_code, body)"""
+    with METRICS.timer('validate_check'):
+        if engine is not None:
+            return engine.validate(validate_url, data, timeout)
+
+        response = get_session().post(
+            validate_url,
+            data=data,
+            timeout=timeout
+        )
+        return response.status_code, response.text
+
+def privacyidea_validate(username, password, client_ip=None, deadline=None):
     """
     Validate user credentials against PrivacyIDEA service
+    Waits no longer than the request deadline (time.monotonic() based)
     """
+    if deadline is None:
+        deadline = time.monotonic() + settings.timeout
+    timeout = deadline - time.monotonic()
+    if timeout <= 0:
+        log(radiusd.L_ERR, f"Request budget exhausted before validating user {username}")
+        return radiusd.RLM_MODULE_FAIL
+
+    key = None
+    if cache is not None or coalescer is not None:
+        key = credentials_key(username, password, client_ip)
+
+    if cache is not None and cache.get(key):
+        log(radiusd.L_INFO, f"Authentication successful for user {username} (cached)")
+        return radiusd.RLM_MODULE_OK
+
+    if coalescer is None:
+        return validate_upstream(username, password, client_ip, timeout, key)
+
+    result = coalescer.do(
+        key,
+        lambda: validate_upstream(username, password, client_ip, timeout, key),
+        timeout
+    )
+    if result is None:
+        log(radiusd.L_ERR, f"Timeout waiting for in-flight validation of user {username}")
+        return radiusd.RLM_MODULE_FAIL
+    return result
+
+def validate_upstream(username, password, client_ip, timeout, key=None):
+    """Send one /validate/check request to PrivacyIDEA"""
+    ticket = None
+    if breaker is not None:
+        ticket = breaker.allow()
+        if ticket is None:
+            if settings.debug:
+                log(radiusd.L_INFO, f"Circuit open, failing user {username} without contacting PrivacyIDEA")
+            return radiusd.RLM_MODULE_FAIL
+
+    outcome = CircuitBreaker.ERROR
+    deadline = time.monotonic() + timeout
     try:
-        # Build validation URL
-        validate_url = urljoin(PRIVACYIDEA_URL, '/validate/check')
-        
         # Prepare request data
-        data = {
-            'user': username,
-            'pass': password
-        }
-        
-        if REALM:
-            data['realm'] = REALM
+        data = settings.body_template.copy()
+        data['user'] = username
+        data['pass'] = password
             
         if client_ip:
             data['client'] = client_ip
         
-        # Make request to PrivacyIDEA
-        if DEBUG:
-            log(radiusd.L_INFO, f"Validating user {username} against PrivacyIDEA at {validate_url}")
-        
-        response = requests.post(
-            validate_url,
-            data=data,
-            verify=VALIDATE_SSL,
-            timeout=TIMEOUT,
-            headers={
-                'Content-Type': 'application/x-www-form-urlencoded',
-                'Accept': 'application/json'
-            }
-        )
+        # Make request to PrivacyIDEA, moving on to the next node only
+        # when the current one could not be connected to
+        for endpoint in balancer.candidates():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("request budget exhausted during failover")
+            if settings.debug:
+                log(radiusd.L_INFO, f"Validating user {username} against PrivacyIDEA at {endpoint.validate_url}")
+
+            balancer.acquire(endpoint)
+            start = time.monotonic()
+            try:
+                status_code, body = post_validate(endpoint.validate_url, data, remaining)
+            except (requests.exceptions.ConnectionError, ConnectionError) as e:
+                balancer.fail(endpoint, str(e))
+                if is_connect_error(e):
+                    log(radiusd.L_ERR, f"Failed to connect to PrivacyIDEA at {endpoint.url}")
+                    continue
+                raise
+            except (requests.exceptions.Timeout, TimeoutError):
+                # A node too slow to answer is ranked down, not ejected
+                balancer.observe(endpoint, time.monotonic() - start)
+                raise
+            finally:
+                balancer.release(endpoint)
+
+            if status_code >= 500:
+                balancer.fail(endpoint, f"status {status_code}")
+            else:
+                balancer.observe(endpoint, time.monotonic() - start)
+            break
+        else:
+            raise ConnectionError("no PrivacyIDEA endpoint reachable")
         
-        if DEBUG:
-            log(radiusd.L_INFO, f"PrivacyIDEA response status: {response.status_code}")
+        if settings.debug:
+            log(radiusd.L_INFO, f"PrivacyIDEA response status: {status_code}")
         
-        if response.status_code == 200:
+        if status_code == 200:
             try:
-                result = response.json()
-                if DEBUG:
+                result = json.loads(body)
+                outcome = CircuitBreaker.SUCCESS
+                if settings.debug:
                     log(radiusd.L_INFO, f"PrivacyIDEA response: {json.dumps(result)}")
                 
                 if result.get('result', {}).get('value'):
                     log(radiusd.L_INFO, f"Authentication successful for user {username}")
+                    if cache is not None:
+                        cache.put(key, result.get('detail', {}).get('type'))
                     return radiusd.RLM_MODULE_OK
                 else:
                     log(radiusd.L_AUTH, f"Authentication failed for user {username}")
                     return radiusd.RLM_MODULE_REJECT
             except json.JSONDecodeError:
-                log(radiusd.L_ERR, f"Invalid JSON response from PrivacyIDEA: {response.text}")
+                log(radiusd.L_ERR, f"Invalid JSON response from PrivacyIDEA: {body}")
                 return radiusd.RLM_MODULE_FAIL
         else:
-            log(radiusd.L_ERR, f"PrivacyIDEA returned status code: {response.status_code}")
-            log(radiusd.L_ERR, f"Response: {response.text}")
+            log(radiusd.L_ERR, f"PrivacyIDEA returned status code: {status_code}")
+            log(radiusd.L_ERR, f"Response: {body}")
             return radiusd.RLM_MODULE_FAIL
             
-    except requests.exceptions.Timeout:
-        log(radiusd.L_ERR, f"PrivacyIDEA request timeout after {TIMEOUT} seconds")
+    except (requests.exceptions.Timeout, TimeoutError):
+        outcome = CircuitBreaker.TIMEOUT
+        log(radiusd.L_ERR, f"PrivacyIDEA request timeout after {timeout:.1f} seconds")
+        return radiusd.RLM_MODULE_FAIL
+    except (requests.exceptions.ConnectionError, ConnectionError) as e:
+        log(radiusd.L_ERR, f"PrivacyIDEA connection failed: {str(e)}")
         return radiusd.RLM_MODULE_FAIL
-    except requests.exceptions.ConnectionError:
-        log(radiusd.L_ERR, f"Failed to connect to PrivacyIDEA at {PRIVACYIDEA_URL}")
+    except EngineBusy as e:
+        # Local saturation says nothing about upstream health
+        outcome = None
+        log(radiusd.L_ERR, f"PrivacyIDEA request queue full: {str(e)}")
         return radiusd.RLM_MODULE_FAIL
     except Exception as e:
         log(radiusd.L_ERR, f"PrivacyIDEA validation error: {str(e)}")
         return radiusd.RLM_MODULE_FAIL
+    finally:
+        if breaker is not None and outcome is not None:
+            breaker.record(ticket, outcome)
+
+def start_balancer():
+    """Create the endpoint balancer for the configured nodes"""
+    global balancer
+
+    balancer = EndpointBalancer(
+        settings.endpoints,
+        alpha=settings.ewma_alpha,
+        backoff=settings.endpoint_backoff,
+        max_backoff=settings.endpoint_max_backoff
+    )
+
+def start_warmup():
+    """Run the startup health check and pool warm-up in the background"""
+    global readiness
+
+    state = readiness = Readiness()
+
+    def run():
+        try:
+            warm_up(state)
+        except Exception as e:
+            log(radiusd.L_ERR, f"PrivacyIDEA warm-up failed: {str(e)}")
+            state.set(Readiness.UNAVAILABLE)
+
+    threading.Thread(target=run, name=f"{MODULE_NAME}-warmup", daemon=True).start()
+
+def start_engine():
+    """Start the async engine if configured, falling back to sync"""
+    global engine
+
+    if settings.engine != 'async':
+        return
+
+    validator = AsyncValidator(
+        max_inflight=settings.max_inflight,
+        max_queue=settings.max_queue,
+        verify_ssl=settings.validate_ssl,
+        headers=settings.headers
+    )
+    try:
+        validator.start()
+    except Exception as e:
+        log(radiusd.L_ERR, f"Async engine unavailable, using sync engine: {str(e)}")
+        return
+
+    engine = validator
+    log(radiusd.L_INFO, f"Async engine started, in-flight cap {settings.max_inflight}, queue {settings.max_queue}")
+
+def start_cache():
+    """Create the result cache if configured"""
+    global cache
+
+    if not settings.cache:
+        return
+
+    cache = ResultCache(settings.cache_ttl, settings.cache_size, settings.cache_allow_otp)
+    log(radiusd.L_INFO, f"Result cache enabled, TTL {settings.cache_ttl}s, size {settings.cache_size}, "
+        f"OTP caching: {settings.cache_allow_otp}")
+
+def start_breaker():
+    """Create the circuit breaker if configured"""
+    global breaker
+
+    if not settings.breaker:
+        return
+
+    breaker = CircuitBreaker(
+        MODULE_NAME,
+        window=settings.breaker_window,
+        min_requests=settings.breaker_min_requests,
+        error_rate=settings.breaker_error_rate,
+        timeout_rate=settings.breaker_timeout_rate,
+        open_interval=settings.breaker_open_interval
+    )
+    log(radiusd.L_INFO, f"Circuit breaker enabled, opens at {settings.breaker_error_rate:.0%} errors "
+        f"or {settings.breaker_timeout_rate:.0%} timeouts over {settings.breaker_window}s")
+
+def start_coalescer():
+    """Create the request coalescer if configured"""
+    global coalescer
+
+    if settings.coalesce:
+        coalescer = Coalescer()
+        log(radiusd.L_INFO, "Request coalescing enabled")
+
+def stop_engine():
+    """Stop the async engine"""
+    global engine
+
+    if engine is not None:
+        engine.stop()
+        engine = None
 
 def instantiate(p):
     """Module instantiation"""
+    global settings
+
+    try:
+        settings = load_settings(getattr(radiusd, 'config', None) or {})
+    except (TypeError, ValueError) as e:
+        log(radiusd.L_ERR, f"Invalid module configuration: {str(e)}")
+        return radiusd.RLM_MODULE_FAIL
+
     log(radiusd.L_INFO, "PrivacyIDEA client module instantiated")
-    log(radiusd.L_INFO, f"PrivacyIDEA URL: {PRIVACYIDEA_URL}")
-    log(radiusd.L_INFO, f"SSL Validation: {VALIDATE_SSL}")
-    log(radiusd.L_INFO, f"Realm: {REALM}")
-    log(radiusd.L_INFO, f"Debug mode: {DEBUG}")
+    log(radiusd.L_INFO, f"PrivacyIDEA endpoints: {', '.join(settings.endpoints)}")
+    log(radiusd.L_INFO, f"SSL Validation: {settings.validate_ssl}")
+    log(radiusd.L_INFO, f"Realm: {settings.realm}")
+    log(radiusd.L_INFO, f"Debug mode: {settings.debug}")
+    log(radiusd.L_INFO, f"Connection pool size: {settings.pool_size}, keep-alive: {settings.keepalive}")
+    start_balancer()
+    start_engine()
+    start_cache()
+    start_breaker()
+    start_coalescer()
+    METRICS.start(settings.metrics_address, settings.metrics_port)
     
-    # Test connection to PrivacyIDEA
-    try:
-        health_url = urljoin(PRIVACYIDEA_URL, '/health')
-        response = requests.get(health_url, timeout=5, verify=VALIDATE_SSL)
-        if response.status_code == 200:
-            log(radiusd.L_INFO, "PrivacyIDEA service is reachable")
-        else:
-            log(radiusd.L_WARN, f"PrivacyIDEA health check returned: {response.status_code}")
-    except Exception as e:
-        log(radiusd.L_WARN, f"PrivacyIDEA health check failed: {str(e)}")
+    # Test connection to PrivacyIDEA without holding up server startup
+    start_warmup()
     
     return radiusd.RLM_MODULE_OK
 
+@METRICS.timed('authenticate')
 def authenticate(p):
     """Process authentication requests"""
+    deadline = time.monotonic() + settings.timeout
+
     # Extract username and password from request
-    username = None
-    password = None
-    client_ip = None
-    
-    for attr in p:
-        if attr[0] == 'User-Name':
-            username = attr[1]
-        elif attr[0] == 'User-Password':
-            password = attr[1]
-        elif attr[0] == 'Client-IP-Address':
-            client_ip = attr[1]
+    username, password, client_ip = REQUEST_ATTRS(p)
     
     if not username or not password:
         log(radiusd.L_AUTH, "Missing username or password")
         return radiusd.RLM_MODULE_INVALID
     
+    # Requests arriving right after startup briefly wait for the warm-up
+    # so they find open connections instead of all handshaking at once
+    if readiness.state == Readiness.STARTING and settings.ready_wait > 0:
+        readiness.wait(min(settings.ready_wait, deadline - time.monotonic()))
+    
     # Validate against PrivacyIDEA
-    return privacyidea_validate(username, password, client_ip)
+    return privacyidea_validate(username, password, client_ip, deadline)
 
 def authorize(p):
     """Process authorization requests"""
@@ -148,6 +825,17 @@ def accounting(p):
 
 def detach(p):
     """Module detach"""
+    METRICS.stop_server()
+    stop_engine()
+    close_session()
+    if balancer is not None:
+        log(radiusd.L_INFO, f"Endpoint stats: {balancer.stats()}")
+    if cache is not None:
+        log(radiusd.L_INFO, f"Result cache stats: {cache.stats()}")
+    if breaker is not None:
+        log(radiusd.L_INFO, f"Circuit breaker stats: {breaker.stats()}")
+    if coalescer is not None:
+        log(radiusd.L_INFO, f"Request coalescing stats: {coalescer.stats()}")
     log(radiusd.L_INFO, "PrivacyIDEA client module detached")
     return radiusd.RLM_MODULE_OK
 
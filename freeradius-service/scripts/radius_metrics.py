@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Latency and Outcome Metrics for FreeRADIUS Python modules
+Per-thread accumulation with an optional Prometheus text endpoint
+"""
+
+import radiusd
+import functools
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0)
+
+RESULT_NAMES = {
+    radiusd.RLM_MODULE_REJECT: 'reject',
+    radiusd.RLM_MODULE_FAIL: 'fail',
+    radiusd.RLM_MODULE_OK: 'ok',
+    radiusd.RLM_MODULE_HANDLED: 'handled',
+    radiusd.RLM_MODULE_INVALID: 'invalid',
+    radiusd.RLM_MODULE_USERLOCK: 'userlock',
+    radiusd.RLM_MODULE_NOTFOUND: 'notfound',
+    radiusd.RLM_MODULE_NOOP: 'noop',
+    radiusd.RLM_MODULE_UPDATED: 'updated'
+}
+
+
+class Shard:
+    """Counters owned by a single thread"""
+
+    __slots__ = ('histograms', 'results', 'events')
+
+    def __init__(self):
+        # call -> [bucket counts..., +Inf count, sum of seconds]
+        self.histograms = {}
+        # (call, result) -> count
+        self.results = {}
+        # event -> count, for what is not the result of a call
+        self.events = {}
+
+    def merge(self, shard):
+        """Add the counters of another shard to this one"""
+        for call, histogram in list(shard.histograms.items()):
+            merged = self.histograms.get(call)
+            if merged is None:
+                self.histograms[call] = list(histogram)
+            else:
+                for i, value in enumerate(histogram):
+                    merged[i] += value
+        for key, value in list(shard.results.items()):
+            self.results[key] = self.results.get(key, 0) + value
+        for key, value in list(shard.events.items()):
+            self.events[key] = self.events.get(key, 0) + value
+
+
+class ShardOwner:
+    """
+    Kept in thread-local storage next to a thread's shard; it is
+    collected when the thread exits, which retires the shard
+    """
+
+    __slots__ = ('__weakref__',)
+
+
+class Metrics:
+    """
+    Latency histograms and result counters for one module
+
+    Every thread records into its own shard, so the request path never
+    takes a lock once a thread has registered. The exporter sums the
+    shards when scraped; a scrape racing a write may miss that single
+    observation, which is then included in the next scrape. When a
+    thread exits its shard is folded into a retired total, so short-lived
+    threads such as per-backend workers do not pile up shards.
+    """
+
+    def __init__(self, module, buckets=BUCKETS):
+        self.module = module
+        self.buckets = buckets
+        self.local = threading.local()
+        self.shards = set()
+        self.retired = Shard()
+        self.lock = threading.Lock()
+        self.server = None
+        self.server_thread = None
+
+    def _shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = Shard()
+            owner = ShardOwner()
+            weakref.finalize(owner, self._retire, shard)
+            with self.lock:
+                self.shards.add(shard)
+            self.local.owner = owner
+            self.local.shard = shard
+            return shard
+
+    def _retire(self, shard):
+        """Fold the shard of an exited thread into the retired total"""
+        with self.lock:
+            self.shards.discard(shard)
+            self.retired.merge(shard)
+
+    def observe(self, call, seconds):
+        """Record the duration of one call"""
+        histograms = self._shard().histograms
+        histogram = histograms.get(call)
+        if histogram is None:
+            histogram = histograms[call] = [0] * (len(self.buckets) + 1) + [0.0]
+        histogram[bisect_left(self.buckets, seconds)] += 1
+        histogram[-1] += seconds
+
+    def count(self, call, result):
+        """Count one result of a call"""
+        results = self._shard().results
+        key = (call, result)
+        results[key] = results.get(key, 0) + 1
+
+    def event(self, name):
+        """Count one occurrence of an event that is not a call result"""
+        events = self._shard().events
+        events[name] = events.get(name, 0) + 1
+
+    @contextmanager
+    def timer(self, call):
+        """Context manager recording the duration of a backend call"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(call, time.perf_counter() - start)
+
+    def timed(self, call):
+        """Decorator recording duration and RLM result of a module entry point"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    rcode = func(*args, **kwargs)
+                except Exception:
+                    self.count(call, 'error')
+                    raise
+                finally:
+                    self.observe(call, time.perf_counter() - start)
+                # Updating modules return (rcode, reply, config)
+                result = rcode[0] if isinstance(rcode, tuple) else rcode
+                self.count(call, RESULT_NAMES.get(result, str(result)))
+                return rcode
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        """Merge all shards into (histograms, results, events)"""
+        total = Shard()
+        with self.lock:
+            shards = list(self.shards)
+            total.merge(self.retired)
+
+        for shard in shards:
+            total.merge(shard)
+        return total.histograms, total.results, total.events
+
+    def render(self):
+        """Render all metrics in the Prometheus text exposition format"""
+        histograms, results, events = self.snapshot()
+        module = self.module
+        lines = [
+            '# HELP radius_python_call_duration_seconds Duration of module entry points and backend calls',
+            '# TYPE radius_python_call_duration_seconds histogram'
+        ]
+        for call, histogram in sorted(histograms.items()):
+            labels = f'module="{module}",call="{call}"'
+            cumulative = 0
+            for bound, value in zip(self.buckets, histogram):
+                cumulative += value
+                lines.append(f'radius_python_call_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            cumulative += histogram[len(self.buckets)]
+            lines.append(f'radius_python_call_duration_seconds_bucket{{{labels},le="+Inf"}} {cumulative}')
+            lines.append(f'radius_python_call_duration_seconds_sum{{{labels}}} {histogram[-1]:.6f}')
+            lines.append(f'radius_python_call_duration_seconds_count{{{labels}}} {cumulative}')
+
+        lines.append('# HELP radius_python_results_total Results returned by module entry points')
+        lines.append('# TYPE radius_python_results_total counter')
+        for (call, result), value in sorted(results.items()):
+            lines.append(f'radius_python_results_total{{module="{module}",call="{call}",result="{result}"}} {value}')
+
+        lines.append('# HELP radius_python_events_total Events counted apart from call results')
+        lines.append('# TYPE radius_python_events_total counter')
+        for event, value in sorted(events.items()):
+            lines.append(f'radius_python_events_total{{module="{module}",event="{event}"}} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def start_server(self, address, port):
+        """Serve /metrics on a background thread"""
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((address, port), MetricsHandler)
+        self.server.daemon_threads = True
+        self.server_thread = threading.Thread(
+            target=self.server.serve_forever,
+            name=f'{self.module}-metrics',
+            daemon=True
+        )
+        self.server_thread.start()
+
+    def start(self, address, port):
+        """Start the metrics listener if a port is set, logging the outcome"""
+        if not port:
+            return
+
+        try:
+            self.start_server(address, port)
+        except OSError as e:
+            radiusd.radlog(radiusd.L_ERR, f"{self.module}: Metrics listener failed on {address}:{port}: {str(e)}")
+            return
+        radiusd.radlog(radiusd.L_INFO, f"{self.module}: Metrics available at http://{address}:{port}/metrics")
+
+    def stop_server(self):
+        """Stop the metrics listener"""
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+            self.server_thread = None
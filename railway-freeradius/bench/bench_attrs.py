@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Attribute Extraction Micro-benchmark
+Compares radius_attrs.attribute_extractor() with the chained `for attr in p`
+loops the Python modules used, on requests carrying many attributes
+
+Usage: python3 bench_attrs.py [-n SIZES] [-r ROUNDS] [-p POSITION]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from radius_attrs import attribute_extractor
+
+EXTRACTOR = attribute_extractor({
+    'User-Name': None,
+    'User-Password': None,
+    'NAS-IP-Address': '127.0.0.1'
+})
+
+
+def legacy_loop(p):
+    """The extraction loop from proxy_loadbalance.authenticate()"""
+    username = None
+    password = None
+    nas_ip = '127.0.0.1'
+
+    for attr in p:
+        if attr[0] == 'User-Name':
+            username = attr[1]
+        elif attr[0] == 'User-Password':
+            password = attr[1]
+        elif attr[0] == 'NAS-IP-Address':
+            nas_ip = attr[1]
+
+    return username, password, nas_ip
+
+
+class Pair:
+    """Stand-in for a pair returned by the pair map interface"""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+
+class PairMapRequest:
+    """Stand-in for the p object passed by the pair map interface"""
+
+    def __init__(self, attrs):
+        self.request = {name: Pair(value) for name, value in attrs}
+
+
+def build_request(count, position):
+    """
+    Build a tuple-of-tuples request with `count` attributes, placing the
+    wanted ones at the start, middle or end of the packet
+    """
+    filler = [(f"Vendor-Attr-{i}", f"value-{i}") for i in range(count - 3)]
+    wanted = [
+        ('User-Name', 'bob'),
+        ('User-Password', '123456'),
+        ('NAS-IP-Address', '10.0.0.1')
+    ]
+    if position == 'start':
+        attrs = wanted + filler
+    elif position == 'end':
+        attrs = filler + wanted
+    else:
+        middle = len(filler) // 2
+        attrs = filler[:middle] + wanted + filler[middle:]
+    return tuple(attrs)
+
+
+def bench(func, arg, rounds):
+    """Return the best per-call time in microseconds"""
+    timer = timeit.Timer(lambda: func(arg))
+    best = min(timer.repeat(repeat=5, number=rounds))
+    return best / rounds * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Attribute extraction micro-benchmark.")
+    parser.add_argument("-n", dest="sizes", help="Comma separated attributes per request.", default="10,60")
+    parser.add_argument("-r", dest="rounds", help="Calls per measurement.", default=20000, type=int)
+    parser.add_argument("-p", dest="position", help="Where the wanted attributes sit: start, middle, end or all.",
+                        default="all", choices=("start", "middle", "end", "all"))
+    args = parser.parse_args()
+
+    positions = ("start", "middle", "end") if args.position == "all" else (args.position,)
+
+    # A repeated attribute resolves to its last occurrence, as in the loop
+    repeated = build_request(10, 'start') + (('User-Name', 'alice'),)
+    assert legacy_loop(repeated) == EXTRACTOR(repeated)
+
+    print(f"{args.rounds} calls per measurement")
+    print(f"{'size':>6}  {'position':<10}{'legacy loop':>14}{'extractor':>14}{'pair map':>14}{'speedup':>10}")
+
+    for size in map(int, args.sizes.split(',')):
+        for position in positions:
+            request = build_request(size, position)
+            assert legacy_loop(request) == EXTRACTOR(request)
+
+            pair_map = PairMapRequest(request)
+            assert EXTRACTOR(pair_map) == EXTRACTOR(request)
+
+            legacy = bench(legacy_loop, request, args.rounds)
+            fast = bench(EXTRACTOR, request, args.rounds)
+            mapped = bench(EXTRACTOR, pair_map, args.rounds)
+            print(f"{size:>6}  {position:<10}{legacy:>12.2f}us{fast:>12.2f}us{mapped:>12.2f}us"
+                  f"{legacy / fast:>9.1f}x")
+
+if __name__ == '__main__':
+    main()
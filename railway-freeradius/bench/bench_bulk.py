@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Bulk HOTP Code Micro-benchmark
+Codes per second of simple_token_auth.hotp() called in a loop against
+hotp_codes(), with and without NumPy, over windows as large as a resync
+or audit scans
+
+Usage: python3 bench_bulk.py [-n COUNTS] [-D DIGEST] [-d DIGITS]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from radius_sim import install_radiusd_stub
+
+SECRET = '3132333435363738393031323334353637383930'
+
+
+def bench(func, count):
+    """Return the best number of codes per second"""
+    timer = timeit.Timer(func)
+    best = min(timer.repeat(repeat=5, number=1))
+    return count / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk HOTP code micro-benchmark.")
+    parser.add_argument("-n", dest="counts", help="Comma separated counter ranges.", default="100,1000,10000,100000")
+    parser.add_argument("-D", dest="digest", help="HMAC digest.", default="sha1", choices=("sha1", "sha256", "sha512"))
+    parser.add_argument("-d", dest="digits", help="Code length.", default=6, type=int)
+    args = parser.parse_args()
+
+    install_radiusd_stub()
+    import simple_token_auth
+
+    numpy = simple_token_auth.numpy
+    if numpy is None:
+        print("NumPy is not installed, only the pure Python batch is measured")
+
+    def loop(count):
+        hotp = simple_token_auth.hotp
+        return [hotp(SECRET, counter, args.digits, args.digest) for counter in range(count)]
+
+    def batch(count, vectorized):
+        simple_token_auth.numpy = numpy if vectorized else None
+        try:
+            return simple_token_auth.hotp_codes(SECRET, 0, count, args.digits, args.digest)
+        finally:
+            simple_token_auth.numpy = numpy
+
+    print(f"{'count':>8}{'hotp() loop/s':>16}{'batch/s':>14}{'numpy/s':>14}{'speedup':>10}")
+    for count in map(int, args.counts.split(',')):
+        expected = [int(code) for code in loop(count)]
+        assert list(batch(count, False)) == expected
+        looped = bench(lambda: loop(count), count)
+        plain = bench(lambda: batch(count, False), count)
+        if numpy is not None:
+            assert [int(code) for code in batch(count, True)] == expected
+            vectorized = bench(lambda: batch(count, True), count)
+            print(f"{count:>8}{looped:>16.0f}{plain:>14.0f}{vectorized:>14.0f}{vectorized / looped:>9.1f}x")
+        else:
+            print(f"{count:>8}{looped:>16.0f}{plain:>14.0f}{'-':>14}{plain / looped:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+HOTP Window Validation Micro-benchmark
+Compares simple_token_auth.hotp_window(), which copies a cached keyed
+HMAC state, with the loop decoding the key and keying a new HMAC for
+every counter, on failed logins that scan the whole window
+
+Usage: python3 bench_hotp.py [-w WINDOWS] [-r ROUNDS]
+"""
+
+import argparse
+import hashlib
+import hmac
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from radius_sim import install_radiusd_stub
+
+SECRET = '3132333435363738393031323334353637383930'
+
+
+def legacy_hotp(secret, counter, digits=6):
+    """hotp() as simple_token_auth had it"""
+    key = bytes.fromhex(secret)
+    counter_bytes = counter.to_bytes(8, byteorder='big')
+    hmac_result = hmac.new(key, counter_bytes, hashlib.sha1).digest()
+    offset = hmac_result[-1] & 0x0f
+    code = ((hmac_result[offset] & 0x7f) << 24) | \
+           ((hmac_result[offset + 1] & 0xff) << 16) | \
+           ((hmac_result[offset + 2] & 0xff) << 8) | \
+           (hmac_result[offset + 3] & 0xff)
+    otp = code % (10 ** digits)
+    return str(otp).zfill(digits)
+
+
+def legacy_window(secret, counter, password, window):
+    """The look-ahead loop from validate_token()"""
+    for i in range(window):
+        expected_otp = legacy_hotp(secret, counter + i)
+        if expected_otp and expected_otp == password:
+            return i
+    return None
+
+
+def bench(func, rounds):
+    """Return the best number of calls per second"""
+    timer = timeit.Timer(func)
+    best = min(timer.repeat(repeat=5, number=rounds))
+    return rounds / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HOTP window validation micro-benchmark.")
+    parser.add_argument("-w", dest="windows", help="Comma separated window sizes.", default="1,10,100,1000")
+    parser.add_argument("-r", dest="rounds", help="Validations per measurement at window 10.", default=2000, type=int)
+    args = parser.parse_args()
+
+    install_radiusd_stub()
+    import simple_token_auth
+
+    # A code outside every window, so each validation scans all of it
+    miss = '000000'
+    while any(legacy_hotp(SECRET, c) == miss for c in range(max(map(int, args.windows.split(','))))):
+        miss = str(int(miss) + 1).zfill(6)
+
+    print(f"{'window':>8}{'legacy/s':>14}{'cached/s':>14}{'speedup':>10}")
+    for window in map(int, args.windows.split(',')):
+        assert legacy_window(SECRET, 0, legacy_hotp(SECRET, window - 1), window) == \
+            simple_token_auth.hotp_window(SECRET, 0, legacy_hotp(SECRET, window - 1), window)
+        rounds = max(1, args.rounds * 10 // window)
+        legacy = bench(lambda: legacy_window(SECRET, 0, miss, window), rounds)
+        cached = bench(lambda: simple_token_auth.hotp_window(SECRET, 0, miss, window), rounds)
+        print(f"{window:>8}{legacy:>14.0f}{cached:>14.0f}{cached / legacy:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Proxy Load Benchmark
+Drives proxy_loadbalance.authenticate() concurrently against simulated
+RADIUS backends (radius_sim) and reports throughput, latency percentiles,
+threads and sockets for each fan-out engine
+
+Usage: python3 bench_proxy.py [-b BACKENDS] [-c CONCURRENCY] [-d SECONDS]
+                              [-l LATENCY] [-a ACCEPT] [-x DROP]
+                              [-B SPEC ...] [-e ENGINES] [-s STRATEGY]
+
+Backends share -l/-a/-x unless given one by one with -B, e.g.
+    -B latency=fixed:2 -B latency=lognormal:5:0.8,accept=0.5,drop=0.01
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from radius_sim import Simulator, install_radiusd_stub, latency_model
+
+SECRET = 'benchsecret'
+
+DICTIONARY = """\
+ATTRIBUTE	User-Name		1	string
+ATTRIBUTE	User-Password		2	string
+ATTRIBUTE	NAS-IP-Address		4	ipaddr
+"""
+
+
+def count_sockets():
+    """Number of sockets open in this process"""
+    count = 0
+    for fd in os.listdir('/proc/self/fd'):
+        try:
+            if os.readlink(f'/proc/self/fd/{fd}').startswith('socket:'):
+                count += 1
+        except OSError:
+            pass
+    return count
+
+
+def percentile(ordered, percent):
+    """Value at percent of an ordered list"""
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+def parse_backend(spec, defaults):
+    """Parse a -B spec of key=value pairs over the shared defaults"""
+    backend = dict(defaults)
+    for item in filter(None, spec.split(',')):
+        key, _, value = item.partition('=')
+        if key == 'latency':
+            latency_model(value)
+            backend[key] = value
+        elif key in ('accept', 'drop'):
+            backend[key] = float(value)
+        else:
+            raise ValueError(f"Unknown backend setting: {key}")
+    return backend
+
+
+def run(module, engine, backends, concurrency, duration):
+    """
+    Drive authenticate() from `concurrency` threads for `duration`
+    seconds and return the measurements
+    """
+    module.ENGINE = engine
+    module.BACKENDS = [
+        {'host': '127.0.0.1', 'port': backend['port'], 'secret': SECRET, 'name': f"backend{i}"}
+        for i, backend in enumerate(backends)
+    ]
+    module.instantiate(None)
+
+    timings = [[] for _ in range(concurrency)]
+    results = [{} for _ in range(concurrency)]
+    stop = threading.Event()
+    peak = {'threads': 0, 'sockets': 0}
+
+    started = [0]
+    original_start = threading.Thread.start
+
+    def counting_start(thread):
+        started[0] += 1
+        original_start(thread)
+
+    def worker(index):
+        # One user per caller, so no request is taken for a retransmission
+        request = (('User-Name', f"bench{index}"), ('User-Password', 'secret'), ('NAS-IP-Address', '127.0.0.1'))
+        timing = timings[index]
+        counts = results[index]
+        while not stop.is_set():
+            start = time.perf_counter()
+            rcode = module.authenticate(request)
+            timing.append(time.perf_counter() - start)
+            if isinstance(rcode, tuple):
+                rcode = rcode[0]
+            counts[rcode] = counts.get(rcode, 0) + 1
+
+    def sampler():
+        while not stop.wait(0.05):
+            peak['threads'] = max(peak['threads'], threading.active_count())
+            peak['sockets'] = max(peak['sockets'], count_sockets())
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    watcher = threading.Thread(target=sampler)
+    threading.Thread.start = counting_start
+    try:
+        for thread in workers + [watcher]:
+            thread.start()
+        started[0] -= len(workers) + 1
+        begin = time.perf_counter()
+        time.sleep(duration)
+        stop.set()
+        for thread in workers + [watcher]:
+            thread.join()
+        elapsed = time.perf_counter() - begin
+    finally:
+        threading.Thread.start = original_start
+        module.detach(None)
+
+    ordered = sorted(t for timing in timings for t in timing)
+    total = len(ordered)
+    accepted = sum(counts.get(module.radiusd.RLM_MODULE_OK, 0) for counts in results)
+    return {
+        'rate': total / elapsed,
+        'p50': percentile(ordered, 50) * 1000,
+        'p99': percentile(ordered, 99) * 1000,
+        'accepted': accepted / max(total, 1) * 100,
+        'threads': peak['threads'],
+        'per_auth': started[0] / max(total, 1),
+        'sockets': peak['sockets']
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Proxy load benchmark against simulated backends.")
+    parser.add_argument("-b", dest="backends", help="Simulated backends.", default=4, type=int)
+    parser.add_argument("-c", dest="concurrency", help="Concurrent authenticate() callers.", default=32, type=int)
+    parser.add_argument("-d", dest="duration", help="Seconds per engine.", default=5.0, type=float)
+    parser.add_argument("-l", dest="latency", help="Backend latency distribution in ms, e.g. fixed:2, "
+                        "uniform:1:5, exp:3 or lognormal:2:0.5.", default="fixed:2")
+    parser.add_argument("-a", dest="accept", help="Share of requests a backend accepts.", default=1.0, type=float)
+    parser.add_argument("-x", dest="drop", help="Share of requests a backend drops.", default=0.0, type=float)
+    parser.add_argument("-B", dest="specs", help="One backend as key=value pairs, repeatable; "
+                        "overrides -b.", action="append", default=[])
+    parser.add_argument("-e", dest="engines", help="Engines to compare.", default="threads,loop")
+    parser.add_argument("-s", dest="strategy", help="Backend selection strategy.", default="all")
+    parser.add_argument("-t", dest="timeout", help="Proxy timeout in seconds.", default=5, type=int)
+    parser.add_argument("-p", dest="port", help="First backend port.", default=21812, type=int)
+    args = parser.parse_args()
+
+    defaults = {'secret': SECRET, 'latency': args.latency, 'accept': args.accept, 'drop': args.drop}
+    latency_model(args.latency)
+    specs = args.specs or [''] * args.backends
+    backends = [dict(parse_backend(spec, defaults), port=args.port + i) for i, spec in enumerate(specs)]
+
+    install_radiusd_stub()
+    import proxy_loadbalance
+
+    workdir = tempfile.TemporaryDirectory()
+    proxy_loadbalance.DICTIONARY_PATH = os.path.join(workdir.name, 'dictionary')
+    proxy_loadbalance.DICTIONARY_CACHE = os.path.join(workdir.name, 'dictionary.pickle')
+    with open(proxy_loadbalance.DICTIONARY_PATH, 'w') as f:
+        f.write(DICTIONARY)
+    proxy_loadbalance.STRATEGY = args.strategy
+    proxy_loadbalance.TIMEOUT = args.timeout
+    proxy_loadbalance.PROBE_INTERVAL = 0
+
+    for backend in backends:
+        print(f"backend :{backend['port']} latency {backend['latency']}, "
+              f"accept {backend['accept']}, drop {backend['drop']}")
+    print(f"strategy {args.strategy}, {args.concurrency} callers, {args.duration}s per engine")
+    print(f"{'engine':<10}{'auth/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'accept %':>10}"
+          f"{'peak threads':>14}{'threads/auth':>14}{'peak sockets':>14}")
+    try:
+        with Simulator(backends):
+            for engine in args.engines.split(','):
+                r = run(proxy_loadbalance, engine, backends, args.concurrency, args.duration)
+                print(f"{engine:<10}{r['rate']:>10.0f}{r['p50']:>10.2f}{r['p99']:>10.2f}{r['accepted']:>10.1f}"
+                      f"{r['threads']:>14}{r['per_auth']:>14.2f}{r['sockets']:>14}")
+    finally:
+        workdir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Local RADIUS Backend Simulator
+Stand-in radiusd module and UDP RADIUS responders with tunable latency,
+accept ratio and drop rate, for benchmarking the FreeRADIUS Python
+modules on one box
+
+Usage: python3 radius_sim.py [-p PORT] [-s SECRET] [-l LATENCY] [-a ACCEPT] [-x DROP]
+"""
+
+import argparse
+import hashlib
+import heapq
+import multiprocessing
+import random
+import select
+import socket
+import struct
+import sys
+import time
+import types
+
+ACCESS_REQUEST = 1
+ACCESS_ACCEPT = 2
+ACCESS_REJECT = 3
+STATUS_SERVER = 12
+
+
+def install_radiusd_stub():
+    """Provide the radiusd module the FreeRADIUS Python modules import"""
+    radiusd = types.ModuleType('radiusd')
+    for value, name in enumerate(('REJECT', 'FAIL', 'OK', 'HANDLED', 'INVALID',
+                                  'USERLOCK', 'NOTFOUND', 'NOOP', 'UPDATED')):
+        setattr(radiusd, f"RLM_MODULE_{name}", value)
+    for value, name in enumerate(('DBG', 'AUTH', 'INFO', 'ERR', 'WARN'), start=1):
+        setattr(radiusd, f"L_{name}", value)
+    radiusd.radlog = lambda level, msg: None
+    radiusd.config = {}
+    sys.modules['radiusd'] = radiusd
+    return radiusd
+
+
+def latency_model(spec):
+    """
+    Parse a latency distribution in milliseconds into a function
+    returning one sample in seconds:
+
+        fixed:MS            always MS
+        uniform:LOW:HIGH    uniform between LOW and HIGH
+        exp:MEAN            exponential with mean MEAN
+        lognormal:MEDIAN:SIGMA
+                            log-normal with median MEDIAN, long tail
+
+    A bare number is taken as fixed.
+    """
+    name, _, params = spec.partition(':')
+    try:
+        if not params:
+            value = float(name) / 1000
+            return lambda: value
+        args = [float(arg) for arg in params.split(':')]
+        if name == 'fixed':
+            value, = args
+            return lambda: value / 1000
+        if name == 'uniform':
+            low, high = args
+            return lambda: random.uniform(low, high) / 1000
+        if name == 'exp':
+            mean, = args
+            return lambda: random.expovariate(1 / mean) / 1000 if mean else 0.0
+        if name == 'lognormal':
+            median, sigma = args
+            return lambda: random.lognormvariate(0, sigma) * median / 1000
+    except ValueError:
+        pass
+    raise ValueError(f"Bad latency distribution: {spec}")
+
+
+def responder(port, secret, latency, accept, drop, ready=None, seed=None):
+    """
+    Minimal RADIUS server on 127.0.0.1:port using a single thread and a
+    timer heap. Each Access-Request is dropped with probability drop,
+    otherwise answered after a latency sample with an Access-Accept with
+    probability accept, else an Access-Reject. Status-Server is always
+    accepted at once.
+    """
+    random.seed(seed)
+    sample = latency_model(latency)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', port))
+    sock.setblocking(False)
+    if ready is not None:
+        ready.set()
+    due = []
+    sequence = 0
+    while True:
+        timeout = max(0.0, due[0][0] - time.monotonic()) if due else None
+        readable, _, _ = select.select([sock], [], [], timeout)
+        if readable:
+            while True:
+                try:
+                    data, address = sock.recvfrom(4096)
+                except BlockingIOError:
+                    break
+                if len(data) < 20:
+                    continue
+                code = data[0]
+                if code == STATUS_SERVER:
+                    delay, reply = 0.0, ACCESS_ACCEPT
+                elif code == ACCESS_REQUEST:
+                    if random.random() < drop:
+                        continue
+                    delay = sample()
+                    reply = ACCESS_ACCEPT if random.random() < accept else ACCESS_REJECT
+                else:
+                    continue
+                sequence += 1
+                heapq.heappush(due, (time.monotonic() + delay, sequence, reply, data[1], data[4:20], address))
+        now = time.monotonic()
+        while due and due[0][0] <= now:
+            _, _, reply, ident, authenticator, address = heapq.heappop(due)
+            header = struct.pack('!BBH', reply, ident, 20)
+            digest = hashlib.md5(header + authenticator + secret).digest()
+            sock.sendto(header + digest, address)
+
+
+class Simulator:
+    """
+    A set of responder processes, one per backend
+
+    Each backend is a dict with port, and optionally secret, latency,
+    accept and drop; see responder(). Use as a context manager.
+    """
+
+    def __init__(self, backends):
+        self.backends = backends
+        self.processes = []
+
+    def start(self):
+        """Start every responder and wait until it listens"""
+        for i, backend in enumerate(self.backends):
+            ready = multiprocessing.Event()
+            process = multiprocessing.Process(
+                target=responder,
+                args=(
+                    backend['port'],
+                    backend.get('secret', 'testing123').encode('utf-8'),
+                    backend.get('latency', 'fixed:2'),
+                    backend.get('accept', 1.0),
+                    backend.get('drop', 0.0),
+                    ready,
+                    backend.get('seed', i)
+                ),
+                daemon=True
+            )
+            process.start()
+            if not ready.wait(5):
+                self.stop()
+                raise RuntimeError(f"Responder on port {backend['port']} did not start")
+            self.processes.append(process)
+        return self
+
+    def stop(self):
+        """Terminate every responder"""
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run one simulated RADIUS backend.")
+    parser.add_argument("-p", dest="port", help="UDP port on 127.0.0.1.", default=1812, type=int)
+    parser.add_argument("-s", dest="secret", help="Shared secret.", default="testing123")
+    parser.add_argument("-l", dest="latency", help="Latency distribution, e.g. exp:5.", default="fixed:2")
+    parser.add_argument("-a", dest="accept", help="Share of requests accepted.", default=1.0, type=float)
+    parser.add_argument("-x", dest="drop", help="Share of requests dropped.", default=0.0, type=float)
+    args = parser.parse_args()
+
+    latency_model(args.latency)
+    print(f"Answering on 127.0.0.1:{args.port}, latency {args.latency}, "
+          f"accept {args.accept}, drop {args.drop}")
+    try:
+        responder(args.port, args.secret.encode('utf-8'), args.latency, args.accept, args.drop)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Circuit Breaker for FreeRADIUS Python modules
+Fails requests fast while an upstream service is erroring or timing out
+"""
+
+import radiusd
+import threading
+import time
+from collections import deque
+
+
+class CircuitBreaker:
+    """
+    Closed / open / half-open circuit breaker over a sliding time window
+
+    While closed every call is allowed and its outcome recorded. When the
+    share of errors (timeouts included) or of timeouts alone within the
+    last `window` seconds crosses its threshold, the circuit opens and
+    allow() returns None without touching the upstream. After
+    `open_interval` seconds a single probe is let through: success closes
+    the circuit, failure opens it for another interval.
+
+    allow() hands out a ticket that must be passed back to record(). Only
+    the outcome of the current probe decides a half-open circuit, and
+    late replies to requests let through before the last transition are
+    ignored.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    # Outcomes passed to record()
+    SUCCESS = 'success'
+    ERROR = 'error'
+    TIMEOUT = 'timeout'
+
+    def __init__(self, name, window=30, min_requests=20, error_rate=0.5,
+                 timeout_rate=0.3, open_interval=10):
+        self.name = name
+        self.window = window
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.open_interval = open_interval
+        self.state = self.CLOSED
+        self.samples = deque()
+        self.errors = 0
+        self.timeouts = 0
+        self.opened_at = 0.0
+        self.probe_started = None
+        # Tickets handed out by allow(); a new one is made on every
+        # transition so outcomes of earlier requests can be told apart
+        self.ticket = object()
+        self.probe = None
+        self.fast_failed = 0
+        self.lock = threading.Lock()
+
+    def _transition(self, state, reason):
+        radiusd.radlog(
+            radiusd.L_WARN if state == self.OPEN else radiusd.L_INFO,
+            f"{self.name}: circuit {self.state} -> {state} ({reason})"
+        )
+        self.state = state
+        self.ticket = object()
+        self.probe = None
+
+    def _reset_window(self):
+        self.samples.clear()
+        self.errors = 0
+        self.timeouts = 0
+
+    def allow(self):
+        """
+        Return a ticket if a request may be sent upstream, else None
+        The ticket goes back to record() with the request's outcome
+        """
+        with self.lock:
+            if self.state == self.CLOSED:
+                return self.ticket
+
+            now = time.monotonic()
+            if self.state == self.OPEN:
+                if now - self.opened_at < self.open_interval:
+                    self.fast_failed += 1
+                    return None
+                self._transition(self.HALF_OPEN, "probing upstream")
+            elif self.probe_started is not None and \
+                    now - self.probe_started < self.open_interval:
+                # Half-open with a probe still outstanding
+                self.fast_failed += 1
+                return None
+
+            # A probe that outlived the interval is given up on and its
+            # outcome will be ignored
+            self.probe_started = now
+            self.probe = object()
+            return self.probe
+
+    def record(self, ticket, outcome):
+        """Record the outcome of a request that allow() let through"""
+        with self.lock:
+            now = time.monotonic()
+
+            if self.state == self.HALF_OPEN:
+                if ticket is not self.probe:
+                    # Not the probe, sent before the circuit opened
+                    return
+                self.probe_started = None
+                if outcome == self.SUCCESS:
+                    self._reset_window()
+                    self._transition(self.CLOSED, "probe succeeded")
+                else:
+                    self.opened_at = now
+                    self._transition(self.OPEN, f"probe failed: {outcome}")
+                return
+
+            if ticket is not self.ticket:
+                # Late reply from a request sent before the last transition
+                return
+
+            self.samples.append((now, outcome))
+            if outcome == self.ERROR:
+                self.errors += 1
+            elif outcome == self.TIMEOUT:
+                self.timeouts += 1
+
+            while self.samples and now - self.samples[0][0] > self.window:
+                _, old = self.samples.popleft()
+                if old == self.ERROR:
+                    self.errors -= 1
+                elif old == self.TIMEOUT:
+                    self.timeouts -= 1
+
+            total = len(self.samples)
+            if total < self.min_requests:
+                return
+
+            failure_rate = (self.errors + self.timeouts) / total
+            timeout_rate = self.timeouts / total
+            if failure_rate >= self.error_rate or timeout_rate >= self.timeout_rate:
+                self.opened_at = now
+                self._transition(
+                    self.OPEN,
+                    f"{failure_rate:.0%} failed, {timeout_rate:.0%} timed out "
+                    f"in last {total} requests"
+                )
+                self._reset_window()
+
+    def stats(self):
+        """Return the current state and counters"""
+        with self.lock:
+            return {
+                'state': self.state,
+                'requests': len(self.samples),
+                'errors': self.errors,
+                'timeouts': self.timeouts,
+                'fast_failed': self.fast_failed
+            }
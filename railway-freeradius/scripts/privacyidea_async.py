@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Asynchronous PrivacyIDEA validation engine for FreeRADIUS
+Multiplexes /validate/check calls from all worker threads over one event loop
+"""
+
+import asyncio
+import concurrent.futures
+import threading
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class EngineBusy(Exception):
+    """Raised when both the in-flight slots and the wait queue are full"""
+
+
+class ConnectFailed(ConnectionError):
+    """Raised when no connection could be opened, so nothing was sent"""
+
+
+class AsyncValidator:
+    """
+    Background asyncio event loop owning a shared HTTP client
+
+    Worker threads submit requests with validate() and block only until
+    the reply arrives or their own time budget runs out. At most
+    max_inflight requests are on the wire, up to max_queue more wait for
+    a free slot and anything beyond that is refused immediately.
+    """
+
+    def __init__(self, max_inflight=64, max_queue=256, verify_ssl=False,
+                 headers=None):
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.verify_ssl = verify_ssl
+        self.headers = headers or {'Accept': 'application/json'}
+        self.loop = None
+        self.thread = None
+        self.client = None
+        self.semaphore = None
+        self.lock = threading.Lock()
+        self.pending = 0
+
+    def start(self):
+        """Start the event loop thread and create the HTTP client"""
+        if aiohttp is None:
+            raise RuntimeError("aiohttp is not installed")
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self._run, name='privacyidea-async', daemon=True
+        )
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._setup(), self.loop).result()
+
+    def stop(self, timeout=5):
+        """Close the HTTP client and stop the event loop"""
+        if self.loop is None:
+            return
+
+        try:
+            asyncio.run_coroutine_threadsafe(
+                self.client.close(), self.loop
+            ).result(timeout)
+        except Exception:
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout)
+        if not self.thread.is_alive():
+            self.loop.close()
+        self.loop = None
+        self.thread = None
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def _setup(self):
+        self.semaphore = asyncio.Semaphore(self.max_inflight)
+        connector = aiohttp.TCPConnector(
+            limit=self.max_inflight,
+            ssl=None if self.verify_ssl else False
+        )
+        self.client = aiohttp.ClientSession(
+            connector=connector, headers=self.headers
+        )
+
+    async def _post(self, url, data, timeout):
+        try:
+            async with self.semaphore:
+                async with self.client.post(
+                    url,
+                    data=data,
+                    timeout=aiohttp.ClientTimeout(total=timeout)
+                ) as response:
+                    return response.status, await response.text()
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"no response within {timeout:.2f}s") from None
+        except aiohttp.ClientConnectorError as e:
+            raise ConnectFailed(str(e)) from e
+        except aiohttp.ClientConnectionError as e:
+            raise ConnectionError(str(e)) from e
+
+    async def _warm(self, url, count, timeout):
+        async def get():
+            async with self.client.get(
+                url,
+                timeout=aiohttp.ClientTimeout(total=timeout)
+            ) as response:
+                await response.read()
+                return response.status
+
+        return await asyncio.gather(
+            *(get() for _ in range(count)), return_exceptions=True
+        )
+
+    def warm(self, url, count, timeout):
+        """
+        Send count concurrent GETs to url so the client holds that many
+        open connections before the first real request
+        Returns a status code or exception per request
+        """
+        return asyncio.run_coroutine_threadsafe(
+            self._warm(url, count, timeout), self.loop
+        ).result(timeout + 1)
+
+    def _done(self, future):
+        with self.lock:
+            self.pending -= 1
+
+    def validate(self, url, data, timeout):
+        """
+        Post form data to url and wait up to timeout seconds
+        Returns (status_code, body), raises TimeoutError, ConnectionError
+        (ConnectFailed if the request never left) or EngineBusy
+        """
+        with self.lock:
+            if self.pending >= self.max_inflight + self.max_queue:
+                raise EngineBusy(f"{self.pending} requests already pending")
+            self.pending += 1
+
+        future = asyncio.run_coroutine_threadsafe(
+            self._post(url, data, timeout), self.loop
+        )
+        future.add_done_callback(self._done)
+
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise TimeoutError(f"no response within {timeout:.2f}s") from None
+
+    def stats(self):
+        """Return the number of queued plus in-flight requests"""
+        with self.lock:
+            return {'pending': self.pending}
@@ -9,20 +9,61 @@ import requests
 import json
 import os
 import sys
+import time
 from urllib.parse import urljoin
+from privacyidea_async import AsyncValidator, EngineBusy
+from circuit_breaker import CircuitBreaker
+from radius_attrs import attribute_extractor
+from radius_metrics import Metrics
 
 # Configuration from environment
 PRIVACYIDEA_URL = os.environ.get('PRIVACYIDEA_URL', 'http://privacyidea:80')
 VALIDATE_SSL = os.environ.get('PRIVACYIDEA_VALIDATE_SSL', 'false').lower() == 'true'
 REALM = os.environ.get('PRIVACYIDEA_REALM', 'default')
 TIMEOUT = int(os.environ.get('PRIVACYIDEA_TIMEOUT', '10'))
+DEBUG = os.environ.get('PRIVACYIDEA_DEBUG', 'false').lower() == 'true'
+
+# Request engine: 'sync' blocks the worker thread for the round trip,
+# 'async' hands requests to a shared background event loop
+ENGINE = os.environ.get('PRIVACYIDEA_ENGINE', 'sync').lower()
+MAX_INFLIGHT = int(os.environ.get('PRIVACYIDEA_MAX_INFLIGHT', '64'))
+MAX_QUEUE = int(os.environ.get('PRIVACYIDEA_MAX_QUEUE', '256'))
+
+# Circuit breaker, fails requests fast while PrivacyIDEA is unhealthy
+BREAKER_ENABLED = os.environ.get('PRIVACYIDEA_BREAKER', 'true').lower() == 'true'
+BREAKER_WINDOW = float(os.environ.get('PRIVACYIDEA_BREAKER_WINDOW', '30'))
+BREAKER_MIN_REQUESTS = int(os.environ.get('PRIVACYIDEA_BREAKER_MIN_REQUESTS', '20'))
+BREAKER_ERROR_RATE = float(os.environ.get('PRIVACYIDEA_BREAKER_ERROR_RATE', '0.5'))
+BREAKER_TIMEOUT_RATE = float(os.environ.get('PRIVACYIDEA_BREAKER_TIMEOUT_RATE', '0.3'))
+BREAKER_OPEN_INTERVAL = float(os.environ.get('PRIVACYIDEA_BREAKER_OPEN_INTERVAL', '10'))
+
+# Optional Prometheus metrics listener, disabled when no port is set
+METRICS_ADDRESS = os.environ.get('PRIVACYIDEA_METRICS_ADDRESS', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('PRIVACYIDEA_METRICS_PORT', '0'))
+
+# Request attributes used by authenticate()
+REQUEST_ATTRS = attribute_extractor({
+    'User-Name': None,
+    'User-Password': None,
+    'Client-IP-Address': None
+})
+
+# Async engine, only set when ENGINE is 'async'
+engine = None
+
+# Circuit breaker, only set when BREAKER_ENABLED
+breaker = None
+
+MODULE_NAME = 'privacyidea_auth'
+
+METRICS = Metrics(MODULE_NAME)
 
 # For demo Vasco tokens
 VASCO_DEMO_URL = "https://gs.onespan.cloud/te-demotokens/go6"
 
 def log(level, msg):
     """Log messages to FreeRADIUS log"""
-    radiusd.radlog(level, f"privacyidea_auth: {msg}")
+    radiusd.radlog(level, f"{MODULE_NAME}: {msg}")
 
 def validate_vasco_demo(username, password):
     """
@@ -44,10 +85,41 @@ def validate_vasco_demo(username, password):
         log(radiusd.L_ERR, f"Vasco demo validation error: {str(e)}")
         return None
 
-def privacyidea_validate(username, password, client_ip=None):
+def post_validate(validate_url, data, timeout):
+    """Send the validation request, returns (status_code, body)"""
+    with METRICS.timer('validate_check'):
+        if engine is not None:
+            return engine.validate(validate_url, data, timeout)
+
+        response = requests.post(
+            validate_url,
+            data=data,
+            verify=VALIDATE_SSL,
+            timeout=timeout
+        )
+        return response.status_code, response.text
+
+def privacyidea_validate(username, password, client_ip=None, deadline=None):
     """
     Validate user credentials against PrivacyIDEA
+    Waits no longer than the request deadline (time.monotonic() based)
     """
+    if deadline is None:
+        deadline = time.monotonic() + TIMEOUT
+    timeout = deadline - time.monotonic()
+    if timeout <= 0:
+        log(radiusd.L_ERR, f"Request budget exhausted before validating user {username}")
+        return radiusd.RLM_MODULE_FAIL
+
+    ticket = None
+    if breaker is not None:
+        ticket = breaker.allow()
+        if ticket is None:
+            if DEBUG:
+                log(radiusd.L_INFO, f"Circuit open, failing user {username} without contacting PrivacyIDEA")
+            return radiusd.RLM_MODULE_FAIL
+
+    outcome = CircuitBreaker.ERROR
     try:
         # Build validation URL
         validate_url = urljoin(PRIVACYIDEA_URL, '/validate/check')
@@ -67,15 +139,11 @@ def privacyidea_validate(username, password, client_ip=None):
         # Make request to PrivacyIDEA
         log(radiusd.L_INFO, f"Validating user {username} against PrivacyIDEA")
         
-        response = requests.post(
-            validate_url,
-            data=data,
-            verify=VALIDATE_SSL,
-            timeout=TIMEOUT
-        )
+        status_code, body = post_validate(validate_url, data, timeout)
         
-        if response.status_code == 200:
-            result = response.json()
+        if status_code == 200:
+            result = json.loads(body)
+            outcome = CircuitBreaker.SUCCESS
             
             if result.get('result', {}).get('value'):
                 log(radiusd.L_INFO, f"Authentication successful for user {username}")
@@ -84,37 +152,89 @@ def privacyidea_validate(username, password, client_ip=None):
                 log(radiusd.L_AUTH, f"Authentication failed for user {username}")
                 return radiusd.RLM_MODULE_REJECT
         else:
-            log(radiusd.L_ERR, f"PrivacyIDEA returned status code: {response.status_code}")
+            log(radiusd.L_ERR, f"PrivacyIDEA returned status code: {status_code}")
             return radiusd.RLM_MODULE_FAIL
             
-    except requests.exceptions.Timeout:
+    except (requests.exceptions.Timeout, TimeoutError):
+        outcome = CircuitBreaker.TIMEOUT
         log(radiusd.L_ERR, "PrivacyIDEA request timeout")
         return radiusd.RLM_MODULE_FAIL
+    except EngineBusy as e:
+        # Local saturation says nothing about upstream health
+        outcome = None
+        log(radiusd.L_ERR, f"PrivacyIDEA request queue full: {str(e)}")
+        return radiusd.RLM_MODULE_FAIL
     except Exception as e:
         log(radiusd.L_ERR, f"PrivacyIDEA validation error: {str(e)}")
         return radiusd.RLM_MODULE_FAIL
+    finally:
+        if breaker is not None and outcome is not None:
+            breaker.record(ticket, outcome)
+
+def start_engine():
+    """Start the async engine if configured, falling back to sync"""
+    global engine
+
+    if ENGINE != 'async':
+        return
+
+    validator = AsyncValidator(
+        max_inflight=MAX_INFLIGHT,
+        max_queue=MAX_QUEUE,
+        verify_ssl=VALIDATE_SSL
+    )
+    try:
+        validator.start()
+    except Exception as e:
+        log(radiusd.L_ERR, f"Async engine unavailable, using sync engine: {str(e)}")
+        return
+
+    engine = validator
+    log(radiusd.L_INFO, f"Async engine started, in-flight cap {MAX_INFLIGHT}, queue {MAX_QUEUE}")
+
+def start_breaker():
+    """Create the circuit breaker if configured"""
+    global breaker
+
+    if not BREAKER_ENABLED:
+        return
+
+    breaker = CircuitBreaker(
+        MODULE_NAME,
+        window=BREAKER_WINDOW,
+        min_requests=BREAKER_MIN_REQUESTS,
+        error_rate=BREAKER_ERROR_RATE,
+        timeout_rate=BREAKER_TIMEOUT_RATE,
+        open_interval=BREAKER_OPEN_INTERVAL
+    )
+    log(radiusd.L_INFO, f"Circuit breaker enabled, opens at {BREAKER_ERROR_RATE:.0%} errors "
+        f"or {BREAKER_TIMEOUT_RATE:.0%} timeouts over {BREAKER_WINDOW}s")
+
+def stop_engine():
+    """Stop the async engine"""
+    global engine
+
+    if engine is not None:
+        engine.stop()
+        engine = None
 
 def instantiate(p):
     """Module instantiation"""
     log(radiusd.L_INFO, "PrivacyIDEA module instantiated")
     log(radiusd.L_INFO, f"PrivacyIDEA URL: {PRIVACYIDEA_URL}")
     log(radiusd.L_INFO, f"SSL Validation: {VALIDATE_SSL}")
+    start_engine()
+    start_breaker()
+    METRICS.start(METRICS_ADDRESS, METRICS_PORT)
     return radiusd.RLM_MODULE_OK
 
+@METRICS.timed('authenticate')
 def authenticate(p):
     """Process authentication requests"""
+    deadline = time.monotonic() + TIMEOUT
+
     # Extract username and password from request
-    username = None
-    password = None
-    client_ip = None
-    
-    for attr in p:
-        if attr[0] == 'User-Name':
-            username = attr[1]
-        elif attr[0] == 'User-Password':
-            password = attr[1]
-        elif attr[0] == 'Client-IP-Address':
-            client_ip = attr[1]
+    username, password, client_ip = REQUEST_ATTRS(p)
     
     if not username or not password:
         log(radiusd.L_AUTH, "Missing username or password")
@@ -127,7 +247,7 @@ def authenticate(p):
             return demo_result
     
     # Validate against PrivacyIDEA
-    return privacyidea_validate(username, password, client_ip)
+    return privacyidea_validate(username, password, client_ip, deadline)
 
 def authorize(p):
     """Process authorization requests"""
@@ -144,6 +264,10 @@ def accounting(p):
 
 def detach(p):
     """Module detach"""
+    METRICS.stop_server()
+    stop_engine()
+    if breaker is not None:
+        log(radiusd.L_INFO, f"Circuit breaker stats: {breaker.stats()}")
     log(radiusd.L_INFO, "PrivacyIDEA module detached")
     return radiusd.RLM_MODULE_OK
 
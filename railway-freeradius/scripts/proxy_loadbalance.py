@@ -2,158 +2,1338 @@
 """
 Proxy Load Balance Module for FreeRADIUS
 Implements "first positive response wins" logic for multiple backends
+
+The winning backend's reply attributes are copied into the reply. An
+Access-Challenge is passed back to the NAS, and the next round carrying
+its State is sent to the backend that issued the challenge only.
 """
 
 import radiusd
 import pyrad.packet
 import pyrad.dictionary
-import pyrad.client
+import hashlib
+import hmac
 import socket
+import struct
+import tempfile
 import threading
 import time
 import json
 import os
+import pickle
+import random
+import selectors
+from collections import OrderedDict, deque
+from radius_attrs import attribute_extractor
+from radius_metrics import Metrics
 
 # Configuration
 BACKENDS = json.loads(os.environ.get('PROXY_BACKENDS', '[]'))
 TIMEOUT = int(os.environ.get('PROXY_TIMEOUT', '5'))
-DICTIONARY_PATH = "/usr/share/freeradius/dictionary"
+DICTIONARY_PATH = os.environ.get('PROXY_DICTIONARY', '/usr/share/freeradius/dictionary')
+
+# Parsed dictionary cache, reused while the dictionary files keep their
+# modification times
+DICTIONARY_CACHE = os.environ.get(
+    'PROXY_DICTIONARY_CACHE',
+    os.path.join(tempfile.gettempdir(), f"proxy_loadbalance-{os.getuid()}.dictionary.pickle")
+)
+
+# Fan-out engine: 'threads' starts one thread per backend per request,
+# 'loop' sends from the request thread and reads every backend socket
+# from a single selector thread
+ENGINE = os.environ.get('PROXY_ENGINE', 'threads').lower()
+
+# Backend selection strategy:
+#   all       send to every backend at once, first accept wins
+#   failover  try backends in configured order
+#   hedged    try the fastest backend, add the next one when no reply
+#             arrived within HEDGE_PERCENTILE of its response times
+#   weighted  try backends in weighted random order ('weight' entry)
+# Except for 'all', backends are treated as replicas, so a reject is
+# final and no further backend is asked.
+STRATEGY = os.environ.get('PROXY_STRATEGY', 'all').lower()
+HEDGE_PERCENTILE = float(os.environ.get('PROXY_HEDGE_PERCENTILE', '95'))
+STRATEGIES = ('all', 'failover', 'hedged', 'weighted')
+
+# Status-Server health probing, off unless an interval is set: only
+# enable it when every backend answers RFC 5997 Status-Server, since a
+# backend failing PROBE_FAILURES probes in a row is skipped until it
+# answers a probe again. Backends with "status_server": false in their
+# PROXY_BACKENDS entry are never probed.
+PROBE_INTERVAL = float(os.environ.get('PROXY_PROBE_INTERVAL', '0'))
+PROBE_TIMEOUT = float(os.environ.get('PROXY_PROBE_TIMEOUT', '2'))
+PROBE_FAILURES = int(os.environ.get('PROXY_PROBE_FAILURES', '3'))
+
+# Admission control, set per backend in its PROXY_BACKENDS entry:
+#   rate          requests per second allowed to the backend, 0 for no limit
+#   burst         requests allowed above rate after an idle spell
+#   max_inflight  outstanding requests allowed, 0 for no limit
+#   saturation    'skip' leaves a saturated backend out of the request,
+#                 'queue' waits for capacity until the timeout
+# How often this happens is counted in stats() and in the metrics.
+
+# Seconds a challenged user has to answer before the State is forgotten,
+# after which the answer is fanned out like a new request
+CHALLENGE_TTL = float(os.environ.get('PROXY_CHALLENGE_TTL', '300'))
+
+# Optional Prometheus metrics listener, disabled when no port is set
+METRICS_ADDRESS = os.environ.get('PROXY_METRICS_ADDRESS', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('PROXY_METRICS_PORT', '0'))
+
+# Retransmitted requests still being proxied join the fan-out already
+# running for them. They are matched on NAS-IP-Address, User-Name and
+# the request authenticator read from DEDUP_ATTRIBUTE. rlm_python does
+# not pass the authenticator itself, so copy it into the request first,
+# e.g. update request { &Tmp-Octets-0 := "%{Packet-Authentication-Vector}" }
+# and set PROXY_DEDUP_ATTRIBUTE=Tmp-Octets-0. Off when unset: nothing
+# else tells a retransmission from a separate login with the same
+# password, and merging those would hand both the same reply and State.
+DEDUP_ATTRIBUTE = os.environ.get('PROXY_DEDUP_ATTRIBUTE', '')
+
+METRICS = Metrics('proxy_loadbalance')
+
+# Request attributes used by authenticate()
+REQUEST_ATTRS = attribute_extractor({
+    'User-Name': None,
+    'User-Password': None,
+    'NAS-IP-Address': '127.0.0.1',
+    'State': None,
+    # Matches no attribute while deduplication is off
+    DEDUP_ATTRIBUTE: None
+})
+
+# RFC 2865 attribute codes, used when the dictionary cannot be loaded
+USER_NAME = 1
+USER_PASSWORD = 2
+NAS_IP_ADDRESS = 4
+STATE = 24
+MESSAGE_AUTHENTICATOR = 80
+
+# Reply attributes describing the hop to the backend, never copied into
+# our own reply
+HOP_ATTRIBUTES = ('Proxy-State', 'Message-Authenticator')
+
+# RADIUS dictionary, loaded in instantiate(); only needed to decode
+# reply attributes. Replies are decoded against an empty one while it
+# cannot be loaded, which leaves their attributes keyed by code.
+DICTIONARY = None
+dictionary_key = None
+NO_DICTIONARY = pyrad.dictionary.Dictionary()
 
-# Load RADIUS dictionary
-try:
-    DICTIONARY = pyrad.dictionary.Dictionary(DICTIONARY_PATH)
-except:
-    DICTIONARY = None
+# Backend proxies with their sockets, created in instantiate()
+proxies = []
+
+# Selector loop, only set when the engine is 'loop'
+loop = None
+
+# Status-Server prober, only set when probing is enabled
+prober = None
+
+# Backend that issued each outstanding Access-Challenge, by State
+challenges = None
+
+# Requests being proxied, for retransmission deduplication
+inflight = None
 
 def log(level, msg):
     """Log messages to FreeRADIUS log"""
     radiusd.radlog(level, f"proxy_loadbalance: {msg}")
 
+def dictionary_files_key(path):
+    """
+    Identify the dictionary by the newest modification time among it
+    and the dictionary files next to it, which it $INCLUDEs
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    mtimes = [os.stat(path).st_mtime_ns]
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.startswith('dictionary'):
+                mtimes.append(entry.stat().st_mtime_ns)
+    return (os.path.abspath(path), max(mtimes), len(mtimes))
+
+def read_dictionary_cache(key):
+    """Return the cached dictionary for key, or None"""
+    try:
+        with open(DICTIONARY_CACHE, 'rb') as f:
+            # Only trust a cache nobody else could have written
+            info = os.fstat(f.fileno())
+            if info.st_uid != os.getuid() or info.st_mode & 0o022:
+                log(radiusd.L_WARN, f"Ignoring dictionary cache {DICTIONARY_CACHE} writable by others")
+                return None
+            cached_key, dictionary = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, ValueError) as e:
+        log(radiusd.L_WARN, f"Ignoring unreadable dictionary cache {DICTIONARY_CACHE}: {str(e)}")
+        return None
+    return dictionary if cached_key == key else None
+
+def write_dictionary_cache(key, dictionary):
+    """Atomically replace the dictionary cache"""
+    directory = os.path.dirname(os.path.abspath(DICTIONARY_CACHE))
+    try:
+        fd, path = tempfile.mkstemp(dir=directory, prefix='.proxy_loadbalance-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((key, dictionary), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(path, DICTIONARY_CACHE)
+        except BaseException:
+            os.unlink(path)
+            raise
+    except (OSError, pickle.PicklingError) as e:
+        log(radiusd.L_WARN, f"Cannot write dictionary cache {DICTIONARY_CACHE}: {str(e)}")
+
+def load_dictionary():
+    """
+    Load the RADIUS dictionary, reusing the loaded or cached copy while
+    the dictionary files are unchanged
+    """
+    global DICTIONARY, dictionary_key
+
+    try:
+        key = dictionary_files_key(DICTIONARY_PATH)
+    except OSError as e:
+        log(radiusd.L_ERR, f"Cannot read RADIUS dictionary {DICTIONARY_PATH}: {str(e)}")
+        return
+    if DICTIONARY is not None and key == dictionary_key:
+        return
+
+    dictionary = read_dictionary_cache(key)
+    if dictionary is None:
+        try:
+            dictionary = pyrad.dictionary.Dictionary(DICTIONARY_PATH)
+        except (OSError, pyrad.dictionary.ParseError) as e:
+            log(radiusd.L_ERR, f"Cannot parse RADIUS dictionary {DICTIONARY_PATH}: {str(e)}")
+            return
+        write_dictionary_cache(key, dictionary)
+        log(radiusd.L_INFO, f"Parsed RADIUS dictionary {DICTIONARY_PATH}")
+
+    DICTIONARY = dictionary
+    dictionary_key = key
+
+def attribute_code(name, default):
+    """Look an attribute code up in the dictionary"""
+    try:
+        return DICTIONARY.attributes[name].code
+    except (AttributeError, KeyError):
+        return default
+
+def state_octets(state):
+    """State as FreeRADIUS prints octets ("0x..."), back to bytes"""
+    if isinstance(state, bytes):
+        return state
+    if state[:2].lower() == '0x':
+        try:
+            return bytes.fromhex(state[2:])
+        except ValueError:
+            pass
+    return state.encode('utf-8')
+
+def attribute_value(value):
+    """Format a decoded reply value the way rlm_python expects it"""
+    if isinstance(value, bytes):
+        return '0x' + value.hex()
+    return str(value)
+
+def reply_attributes(reply):
+    """
+    Convert the attributes of a backend reply to an rlm_python update
+    tuple; attributes missing from the dictionary are skipped, except
+    State, which the NAS needs to answer a challenge
+    """
+    attributes = []
+    for key in reply.keys():
+        name = 'State' if key == STATE else key
+        if not isinstance(name, str) or name in HOP_ATTRIBUTES:
+            continue
+        try:
+            values = reply[key]
+        except (KeyError, ValueError, TypeError, struct.error) as e:
+            log(radiusd.L_DBG, f"Skipping undecodable reply attribute {name}: {str(e)}")
+            continue
+        for i, value in enumerate(values):
+            # Replace what earlier modules set, keep repeated attributes
+            attributes.append((name, ':=' if i == 0 else '+=', attribute_value(value)))
+    return tuple(attributes)
+
+class ChallengeMap:
+    """
+    Remembers which backend issued each outstanding Access-Challenge
+
+    Entries expire after ttl seconds and are dropped oldest first once
+    size are outstanding, so abandoned challenges cannot pile up.
+    """
+
+    def __init__(self, ttl, size=65536):
+        self.ttl = ttl
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _expire(self, now):
+        entries = self.entries
+        while entries:
+            state, (name, expires) = next(iter(entries.items()))
+            if expires > now and len(entries) <= self.size:
+                break
+            del entries[state]
+
+    def put(self, state, name):
+        """Remember that backend name issued the challenge with state"""
+        now = time.monotonic()
+        with self.lock:
+            self.entries.pop(state, None)
+            self.entries[state] = (name, now + self.ttl)
+            self._expire(now)
+
+    def pop(self, state):
+        """Return and forget the backend that issued state, or None"""
+        now = time.monotonic()
+        with self.lock:
+            self._expire(now)
+            entry = self.entries.pop(state, None)
+        return entry[0] if entry is not None else None
+
+    def __len__(self):
+        return len(self.entries)
+
+class PacketTemplate:
+    """
+    Precompiled Access-Request and Status-Server encoder for one backend
+
+    Attribute codes are resolved once, so encoding a request is packing
+    the header and the attributes plus the RFC 2865 User-Password
+    hiding, with no dictionary lookups on the request path.
+    """
+
+    def __init__(self, secret):
+        self.secret = secret
+        self.user_name = attribute_code('User-Name', USER_NAME)
+        self.user_password = attribute_code('User-Password', USER_PASSWORD)
+        self.nas_ip_address = attribute_code('NAS-IP-Address', NAS_IP_ADDRESS)
+        self.state = attribute_code('State', STATE)
+        self.message_authenticator = attribute_code('Message-Authenticator', MESSAGE_AUTHENTICATOR)
+
+    def hide_password(self, password, authenticator):
+        """User-Password hiding as in RFC 2865 section 5.2"""
+        if len(password) > 128:
+            raise ValueError("User-Password longer than 128 octets")
+        padded = password.ljust(max(16, (len(password) + 15) // 16 * 16), b'\0')
+        hidden = bytearray()
+        last = authenticator
+        for i in range(0, len(padded), 16):
+            digest = hashlib.md5(self.secret + last).digest()
+            last = bytes(a ^ b for a, b in zip(padded[i:i + 16], digest))
+            hidden += last
+        return bytes(hidden)
+
+    def access_request(self, ident, username, password, nas_ip, state=None):
+        """
+        Return (packet, request authenticator) for an Access-Request,
+        echoing the State of a challenge when given
+        """
+        authenticator = os.urandom(16)
+        username = username.encode('utf-8')
+        if len(username) > 253:
+            raise ValueError("User-Name longer than 253 octets")
+        hidden = self.hide_password(password.encode('utf-8'), authenticator)
+        attributes = b''.join((
+            struct.pack('!BB', self.user_name, len(username) + 2), username,
+            struct.pack('!BB', self.user_password, len(hidden) + 2), hidden,
+            struct.pack('!BB', self.nas_ip_address, 6), socket.inet_aton(nas_ip)
+        ))
+        if state is not None:
+            state = state_octets(state)
+            if not 0 < len(state) <= 253:
+                raise ValueError("State must be 1 to 253 octets")
+            attributes += struct.pack('!BB', self.state, len(state) + 2) + state
+        header = struct.pack('!BBH', pyrad.packet.AccessRequest, ident, 20 + len(attributes))
+        return header + authenticator + attributes, authenticator
+
+    def status_server(self, ident):
+        """Return (packet, request authenticator) for a Status-Server"""
+        authenticator = os.urandom(16)
+        # RFC 5997 requires a Message-Authenticator, signed over the
+        # packet with the attribute value zeroed
+        header = struct.pack('!BBH', pyrad.packet.StatusServer, ident, 38)
+        attribute = struct.pack('!BB', self.message_authenticator, 18)
+        unsigned = header + authenticator + attribute + b'\0' * 16
+        signature = hmac.new(self.secret, unsigned, hashlib.md5).digest()
+        return header + authenticator + attribute + signature, authenticator
+
+class PendingRequest:
+    """A request waiting for its reply"""
+
+    __slots__ = ('authenticator', 'done', 'reply', 'callback')
+
+    def __init__(self, authenticator, callback=None):
+        self.authenticator = authenticator
+        self.done = threading.Event()
+        self.reply = None
+        # Called with the reply on the reading thread
+        self.callback = callback
+
+class ProxyLoop:
+    """
+    One selector thread reading the sockets of every backend
+
+    Replaces the reader thread per socket. Sockets are handed over with
+    add() from any thread and registered by the loop itself.
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ, None)
+        self.added = deque()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """Start the loop thread"""
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="proxy-loop", daemon=True)
+        self.thread.start()
+
+    def add(self, backend_socket):
+        """Start reading replies for backend_socket"""
+        self.added.append(backend_socket)
+        self._wake()
+
+    def stop(self):
+        """Stop the loop thread, the sockets stay open"""
+        self.running = False
+        self._wake()
+        self.thread.join(2)
+        self.selector.close()
+        self.wake_r.close()
+        self.wake_w.close()
+
+    def _wake(self):
+        try:
+            self.wake_w.send(b'\0')
+        except OSError:
+            pass
+
+    def _run(self):
+        while self.running:
+            for key, _ in self.selector.select():
+                backend_socket = key.data
+                if backend_socket is None:
+                    try:
+                        self.wake_r.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    while self.added:
+                        added = self.added.popleft()
+                        self.selector.register(added.sock, selectors.EVENT_READ, added)
+                    continue
+
+                # Drain everything that arrived since the last wake-up
+                while True:
+                    try:
+                        data = backend_socket.sock.recv(4096)
+                    except (BlockingIOError, ConnectionRefusedError):
+                        break
+                    except OSError:
+                        self.selector.unregister(backend_socket.sock)
+                        break
+                    backend_socket.handle_datagram(data)
+
+class BackendSocket:
+    """
+    Long-lived UDP socket to one backend
+
+    Outstanding requests are keyed by RADIUS identifier, so up to 256
+    share the socket. A reader looks every reply up by identifier and
+    checks its response authenticator against the request authenticator
+    before waking the caller; late replies to an earlier user of the
+    identifier and stray datagrams are dropped. The reader is a thread
+    of its own, or the shared ProxyLoop when one is given.
+    """
+
+    def __init__(self, host, port, secret, name, loop=None):
+        family, _, _, _, address = socket.getaddrinfo(host, port, type=socket.SOCK_DGRAM)[0]
+        self.name = name
+        self.secret = secret
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.sock.connect(address)
+        self.pending = {}
+        self.free_ids = deque(range(256))
+        self.lock = threading.Lock()
+        self.stray = 0
+        self.running = True
+        self.thread = None
+        if loop is not None:
+            self.sock.setblocking(False)
+            loop.add(self)
+        else:
+            # Lets the reader notice close() without a datagram arriving
+            self.sock.settimeout(1.0)
+            self.thread = threading.Thread(target=self._read, name=f"proxy-{name}", daemon=True)
+            self.thread.start()
+
+    def reserve(self):
+        """Return a free identifier, or None if 256 requests are outstanding"""
+        with self.lock:
+            if not self.free_ids:
+                return None
+            return self.free_ids.popleft()
+
+    def release(self, ident):
+        """Forget the request using ident and make the identifier reusable"""
+        with self.lock:
+            self.pending.pop(ident, None)
+            self.free_ids.append(ident)
+
+    def send(self, ident, packet, authenticator, fanout=None, callback=None):
+        """Send an encoded packet under a reserved identifier without waiting"""
+        pending = PendingRequest(authenticator, callback)
+        with self.lock:
+            self.pending[ident] = pending
+        if fanout is not None:
+            fanout.track(pending)
+        self.sock.send(packet)
+        return pending
+
+    def request(self, ident, packet, authenticator, timeout, fanout=None):
+        """
+        Send packet under a reserved identifier, return the reply or None
+        on timeout or when the fan-out it belongs to is cancelled
+        """
+        pending = self.send(ident, packet, authenticator, fanout)
+        pending.done.wait(timeout)
+        return pending.reply
+
+    def handle_datagram(self, data):
+        """
+        Route one received datagram to the request it answers. Whatever
+        goes wrong with one datagram is logged and counted as stray, so
+        the reader, or the ProxyLoop shared by every backend, keeps going
+        """
+        try:
+            self._route(data)
+        except Exception as e:
+            self.stray += 1
+            log(radiusd.L_ERR, f"Dropped reply from backend {self.name}: {e!r}")
+
+    def _route(self, data):
+        length = struct.unpack('!H', data[2:4])[0] if len(data) >= 20 else 0
+        if length < 20 or length > len(data):
+            self.stray += 1
+            return
+        data = data[:length]
+        with self.lock:
+            pending = self.pending.get(data[1])
+        if pending is None or pending.reply is not None:
+            self.stray += 1
+            return
+        # Response authenticator, RFC 2865 section 3
+        digest = hashlib.md5(data[:4] + pending.authenticator + data[20:] + self.secret).digest()
+        if not hmac.compare_digest(digest, data[4:20]):
+            self.stray += 1
+            return
+        try:
+            reply = pyrad.packet.Packet(
+                packet=data,
+                secret=self.secret,
+                authenticator=pending.authenticator,
+                dict=DICTIONARY if DICTIONARY is not None else NO_DICTIONARY
+            )
+        except pyrad.packet.PacketError:
+            self.stray += 1
+            return
+        pending.reply = reply
+        try:
+            if pending.callback is not None:
+                pending.callback(reply)
+        finally:
+            pending.done.set()
+
+    def _read(self):
+        while self.running:
+            try:
+                data = self.sock.recv(4096)
+            except socket.timeout:
+                continue
+            except ConnectionRefusedError:
+                # ICMP port unreachable from the backend, requests time out
+                continue
+            except OSError:
+                break
+            self.handle_datagram(data)
+
+    def close(self):
+        """Stop the reader and close the socket"""
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(2)
+        self.sock.close()
+
+class LatencyStats:
+    """Response times and result counts of one backend"""
+
+    def __init__(self, samples=256, alpha=0.2):
+        self.samples = deque(maxlen=samples)
+        self.alpha = alpha
+        self.ewma = None
+        self.results = {}
+        self.lock = threading.Lock()
+
+    def record(self, success, message, seconds, replied):
+        """
+        Record one request that took seconds until its reply, or until it
+        was given up on when it got none
+        """
+        if success:
+            result = 'accept'
+        elif message == "Access-Reject":
+            result = 'reject'
+        elif message == "Access-Challenge":
+            result = 'challenge'
+        elif message in ("Timeout", "Cancelled"):
+            result = message.lower()
+        else:
+            result = 'error'
+        if not replied and result == 'error':
+            # Nothing useful was measured, rank it as slow as it can be
+            seconds = TIMEOUT
+        with self.lock:
+            self.results[result] = self.results.get(result, 0) + 1
+            if replied:
+                self.samples.append(seconds)
+            elif self.ewma is not None and seconds <= self.ewma:
+                # The real response time is at least seconds, which the
+                # average already accounts for
+                return
+            if self.ewma is None:
+                self.ewma = seconds
+            else:
+                self.ewma += self.alpha * (seconds - self.ewma)
+
+    def percentile(self, percent, minimum=10):
+        """Response time at percent, None with fewer than minimum samples"""
+        with self.lock:
+            if len(self.samples) < minimum:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+    def snapshot(self):
+        """Return the EWMA, percentiles in milliseconds and result counts"""
+        def ms(value):
+            return round(value * 1000, 1) if value is not None else None
+
+        stats = {
+            'ewma_ms': ms(self.ewma),
+            'p50_ms': ms(self.percentile(50, 1)),
+            'p99_ms': ms(self.percentile(99, 1))
+        }
+        with self.lock:
+            stats.update(self.results)
+        return stats
+
+class Admission:
+    """
+    Token bucket and in-flight cap guarding one backend
+
+    A request needs a token, refilled at rate per second up to burst,
+    and one of max_inflight slots, held until the request is over. A
+    rate or max_inflight of 0 means no limit. When the backend is
+    saturated the request either skips it or queues for it, depending
+    on mode.
+    """
+
+    def __init__(self, rate=0, burst=None, max_inflight=0, mode='skip'):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1.0, self.rate))
+        self.max_inflight = int(max_inflight)
+        self.mode = mode
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.inflight = 0
+        self.counts = {'admitted': 0, 'queued': 0, 'skipped': 0, 'queue_timeouts': 0, 'abandoned': 0}
+        self.cond = threading.Condition()
+
+    def _take(self):
+        """Take a token and a slot if both are free, else return the wait"""
+        if self.max_inflight and self.inflight >= self.max_inflight:
+            # Woken by release()
+            return None
+        if self.rate:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+            self.tokens -= 1
+        self.inflight += 1
+        return 0
+
+    def try_acquire(self):
+        """Admit a request if the backend has capacity right now"""
+        with self.cond:
+            if self._take() == 0:
+                self.counts['admitted'] += 1
+                return True
+            return False
+
+    def acquire(self, timeout, abandon=None, poll=0.05):
+        """
+        Wait up to timeout for capacity; gives up early once abandon()
+        is true, checked every poll seconds
+        """
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            self.counts['queued'] += 1
+            while True:
+                wait = self._take()
+                if wait == 0:
+                    self.counts['admitted'] += 1
+                    return True
+                if abandon is not None and abandon():
+                    self.counts['abandoned'] += 1
+                    return False
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.counts['queue_timeouts'] += 1
+                    return False
+                self.cond.wait(min(remaining, poll, wait if wait is not None else poll))
+
+    def skip(self):
+        """Count a request that left the backend out"""
+        with self.cond:
+            self.counts['skipped'] += 1
+
+    def release(self):
+        """Return the slot of a finished request"""
+        with self.cond:
+            self.inflight -= 1
+            self.cond.notify()
+
+    def snapshot(self):
+        """Return the limits, current in-flight count and counters"""
+        with self.cond:
+            stats = dict(self.counts)
+            stats['inflight'] = self.inflight
+        stats.update(rate=self.rate, burst=self.burst, max_inflight=self.max_inflight, mode=self.mode)
+        return stats
+
 class BackendProxy:
     """Handles proxying to a single backend"""
     
-    def __init__(self, config):
+    def __init__(self, config, loop=None):
         self.host = config['host']
         self.port = config.get('port', 1812)
         self.secret = config['secret'].encode('utf-8')
         self.name = config.get('name', self.host)
+        self.weight = float(config.get('weight', 1))
+        self.latency = LatencyStats()
+        self.probe = bool(config.get('status_server', True))
+        self.healthy = True
+        self.probe_failures = 0
+        saturation = config.get('saturation', 'skip')
+        if saturation not in ('skip', 'queue'):
+            log(radiusd.L_WARN, f"Unknown saturation {saturation} for backend {self.name}, skipping it when saturated")
+            saturation = 'skip'
+        self.admission = Admission(
+            config.get('rate', 0),
+            config.get('burst'),
+            config.get('max_inflight', 0),
+            saturation
+        )
+        # Each socket carries up to 256 outstanding requests
+        self.max_sockets = int(config.get('max_sockets', 16))
+        self.sockets = []
+        self.lock = threading.Lock()
+        self.loop = loop
+        self.template = None
+
+    def start(self):
+        """Open the first socket to the backend"""
+        self.template = PacketTemplate(self.secret)
+        self.sockets.append(BackendSocket(self.host, self.port, self.secret, self.name, self.loop))
+
+    def stop(self):
+        """Close all sockets to the backend"""
+        with self.lock:
+            sockets, self.sockets = self.sockets, []
+        for sock in sockets:
+            sock.close()
+
+    def _reserve(self):
+        """Return (socket, identifier) for a new request, or (None, None)"""
+        with self.lock:
+            for sock in self.sockets:
+                ident = sock.reserve()
+                if ident is not None:
+                    return sock, ident
+            if len(self.sockets) >= self.max_sockets:
+                return None, None
+            sock = BackendSocket(self.host, self.port, self.secret, self.name, self.loop)
+            self.sockets.append(sock)
+            return sock, sock.reserve()
+
+    def stats(self):
+        """Return socket and outstanding request counts"""
+        with self.lock:
+            sockets = list(self.sockets)
+        return {
+            'sockets': len(sockets),
+            'outstanding': sum(len(sock.pending) for sock in sockets),
+            'stray_replies': sum(sock.stray for sock in sockets),
+            'healthy': self.healthy,
+            'probe_failures': self.probe_failures,
+            'admission': self.admission.snapshot(),
+            'latency': self.latency.snapshot()
+        }
+
+    def send_status(self):
+        """
+        Send a Status-Server probe without waiting
+        Returns (socket, identifier, pending) or None if it was not sent
+        """
+        sock, ident = self._reserve()
+        if sock is None:
+            return None
+        try:
+            packet, authenticator = self.template.status_server(ident)
+            return sock, ident, sock.send(ident, packet, authenticator)
+        except Exception as e:
+            sock.release(ident)
+            log(radiusd.L_DBG, f"Status-Server to backend {self.name} failed: {str(e)}")
+            return None
+
+    def probe_result(self, answered):
+        """Update health from one probe, ejecting or restoring the backend"""
+        if answered:
+            if not self.healthy:
+                log(radiusd.L_INFO, f"Backend {self.name} answers Status-Server again, back in rotation")
+            self.healthy = True
+            self.probe_failures = 0
+            return
+
+        self.probe_failures += 1
+        if self.healthy and self.probe_failures >= PROBE_FAILURES:
+            self.healthy = False
+            log(radiusd.L_WARN, f"Backend {self.name} ejected after {self.probe_failures} "
+                f"unanswered Status-Server probes")
         
-    def send_request(self, username, password, nas_ip='127.0.0.1'):
+    def send_request(self, username, password, nas_ip='127.0.0.1', fanout=None, state=None):
         """Send authentication request to backend"""
+        start = time.perf_counter()
+        with METRICS.timer(f"backend:{self.name}"):
+            success, message, reply = self._send_request(username, password, nas_ip, fanout, state)
+        self.latency.record(success, message, time.perf_counter() - start, reply is not None)
+        return success, message, reply
+
+    def _send_request(self, username, password, nas_ip, fanout, state):
+        sock, ident = self._reserve()
+        if sock is None:
+            return False, "No free RADIUS identifier", None
+
         try:
-            # Create RADIUS client
-            client = pyrad.client.Client(
-                server=self.host,
-                authport=self.port,
-                secret=self.secret,
-                dict=DICTIONARY
-            )
-            client.timeout = TIMEOUT
-            
-            # Create Access-Request packet
-            req = client.CreateAuthPacket(code=pyrad.packet.AccessRequest)
-            req["User-Name"] = username
-            req["User-Password"] = req.PwCrypt(password)
-            req["NAS-IP-Address"] = nas_ip
+            packet, authenticator = self.template.access_request(ident, username, password, nas_ip, state)
             
-            # Send request and get reply
-            reply = client.SendPacket(req)
+            # Send request and wait for the reader to hand us the reply
+            reply = sock.request(ident, packet, authenticator, TIMEOUT, fanout)
+            if reply is None:
+                if fanout is not None and fanout.cancelled:
+                    return False, "Cancelled", None
+                return False, "Timeout", None
             
-            if reply.code == pyrad.packet.AccessAccept:
-                return True, "Access-Accept", reply
-            elif reply.code == pyrad.packet.AccessReject:
-                return False, "Access-Reject", reply
-            else:
-                return False, f"Unknown code: {reply.code}", reply
+            return self._result(reply)
                 
-        except socket.timeout:
-            return False, "Timeout", None
         except Exception as e:
             return False, str(e), None
+        finally:
+            sock.release(ident)
+
+    def submit(self, username, password, nas_ip, fanout, state=None):
+        """
+        Send authentication request to backend without waiting
+        The reply is recorded in fanout by the reading thread. Returns
+        the handle to pass to collect() once the fan-out is over, or None
+        if nothing was sent.
+        """
+        sock, ident = self._reserve()
+        if sock is None:
+            fanout.add(self.name, False, "No free RADIUS identifier", None)
+            return None
+
+        start = time.perf_counter()
+
+        def on_reply(reply):
+            elapsed = time.perf_counter() - start
+            METRICS.observe(f"backend:{self.name}", elapsed)
+            success, message, reply = self._result(reply)
+            self.latency.record(success, message, elapsed, True)
+            fanout.add(self.name, success, message, reply)
+            log_backend_result(self.name, success, message)
+
+        try:
+            packet, authenticator = self.template.access_request(ident, username, password, nas_ip, state)
+            sock.send(ident, packet, authenticator, fanout, on_reply)
+        except Exception as e:
+            sock.release(ident)
+            fanout.add(self.name, False, str(e), None)
+            self.latency.record(False, str(e), 0.0, False)
+            log_backend_result(self.name, False, str(e))
+            return None
+        return sock, ident, start
+
+    def collect(self, handle, fanout):
+        """Release the identifier of a submitted request"""
+        sock, ident, start = handle
+        sock.release(ident)
+        if self.name not in fanout.results:
+            message = "Cancelled" if fanout.decided() else "Timeout"
+            self.latency.record(False, message, time.perf_counter() - start, False)
+            log_backend_result(self.name, False, message)
+
+    def _result(self, reply):
+        """Map a reply to (success, message, reply)"""
+        if reply.code == pyrad.packet.AccessAccept:
+            return True, "Access-Accept", reply
+        elif reply.code == pyrad.packet.AccessReject:
+            return False, "Access-Reject", reply
+        elif reply.code == pyrad.packet.AccessChallenge:
+            return False, "Access-Challenge", reply
+        else:
+            return False, f"Unknown code: {reply.code}", reply
+
+class FanOut:
+    """
+    Collects the backend results of one proxied request
+
+    The caller is woken as soon as a backend accepts (or, with replicas,
+    rejects or challenges) or every backend asked so far has answered,
+    whichever comes first. cancel() then wakes requests still waiting
+    on other backends so their identifiers are released instead of
+    being held until the timeout.
+
+    Without replicas a challenge only wins once no other backend
+    accepted.
+    """
+
+    def __init__(self, replicas=False):
+        self.replicas = replicas
+        self.expected = 0
+        self.results = {}
+        self.winner = None
+        self.rejected = None
+        self.challenged = None
+        self.cancelled = False
+        self.waiting = []
+        self.cond = threading.Condition()
+
+    def expect(self):
+        """Count one more backend being asked"""
+        with self.cond:
+            self.expected += 1
+
+    def decided(self):
+        """True once a backend gave a final answer"""
+        return (self.winner is not None or self.rejected is not None
+                or (self.replicas and self.challenged is not None))
+
+    def track(self, pending):
+        """Register an outstanding backend request for cancellation"""
+        with self.cond:
+            if self.cancelled:
+                pending.done.set()
+            else:
+                self.waiting.append(pending)
+
+    def add(self, name, success, message, reply):
+        """Record the result of one backend"""
+        with self.cond:
+            self.results[name] = {
+                'success': success,
+                'message': message,
+                'reply': reply
+            }
+            if success and self.winner is None:
+                self.winner = name
+            elif message == "Access-Challenge" and self.challenged is None:
+                self.challenged = name
+            elif self.replicas and message == "Access-Reject" and self.rejected is None:
+                self.rejected = name
+            self.cond.notify_all()
+
+    def wait(self, timeout):
+        """
+        Wait for a final answer or for all backends asked so far, up to
+        timeout; True if a final answer arrived
+        """
+        with self.cond:
+            self.cond.wait_for(
+                lambda: self.decided() or len(self.results) >= self.expected,
+                timeout
+            )
+            return self.decided()
+
+    def cancel(self):
+        """Abandon the backend requests still in flight"""
+        with self.cond:
+            self.cancelled = True
+            waiting, self.waiting = self.waiting, []
+        for pending in waiting:
+            pending.done.set()
+
+class InFlight:
+    """
+    Requests being proxied, by retransmission key
+
+    The first arrival runs the fan-out; duplicates arriving meanwhile
+    wait for its result instead of starting another one.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def run(self, key, timeout, func, *args):
+        """Return func(*args), shared with concurrent calls for key"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = [threading.Event(), radiusd.RLM_MODULE_FAIL]
+                leader = True
+            else:
+                self.suppressed += 1
+                leader = False
 
-def proxy_to_backends(username, password, nas_ip='127.0.0.1'):
+        if not leader:
+            # The call itself is counted with its result by authenticate()
+            METRICS.event('duplicate')
+            log(radiusd.L_DBG, f"Retransmission for {key[1]} joined the request in flight")
+            if not entry[0].wait(timeout):
+                log(radiusd.L_ERR, f"Request in flight for {key[1]} did not finish")
+            return entry[1]
+
+        try:
+            entry[1] = func(*args)
+            return entry[1]
+        finally:
+            with self.lock:
+                del self.entries[key]
+            entry[0].set()
+
+class StatusProber:
     """
-    Proxy request to all backends in parallel
-    Return success if ANY backend accepts
+    Background Status-Server prober
+
+    Every interval a Status-Server goes to each backend at once, then
+    the replies are collected within the probe timeout. Any verified
+    reply counts as alive.
+    """
+
+    def __init__(self, backends, interval, timeout):
+        self.backends = backends
+        self.interval = interval
+        self.timeout = timeout
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Start the probe thread"""
+        self.thread = threading.Thread(target=self._run, name="proxy-prober", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the probe thread"""
+        self.stopping.set()
+        self.thread.join(self.timeout + 1)
+
+    def _run(self):
+        while not self.stopping.is_set():
+            try:
+                self.probe_all()
+            except Exception as e:
+                log(radiusd.L_ERR, f"Status-Server probing failed: {str(e)}")
+            self.stopping.wait(self.interval)
+
+    def probe_all(self):
+        """Probe every backend once"""
+        sent = [(proxy, proxy.send_status()) for proxy in self.backends]
+        deadline = time.monotonic() + self.timeout
+        for proxy, probe in sent:
+            answered = False
+            if probe is not None:
+                sock, ident, pending = probe
+                pending.done.wait(max(0, deadline - time.monotonic()))
+                answered = pending.reply is not None
+                sock.release(ident)
+            proxy.probe_result(answered)
+
+def log_backend_result(name, success, message):
+    """Log the outcome of one backend request"""
+    if success or message == "Access-Challenge":
+        log(radiusd.L_INFO, f"Backend {name} returned: {message}")
+    else:
+        log(radiusd.L_AUTH, f"Backend {name} failed: {message}")
+
+def backend_order(backends):
+    """Return the backends in the order the strategy asks them"""
+    if STRATEGY == 'hedged':
+        # Unmeasured backends first so every backend gets samples
+        return sorted(backends, key=lambda proxy: proxy.latency.ewma or 0.0)
+    if STRATEGY == 'weighted':
+        # Weighted random order without replacement (Efraimidis-Spirakis)
+        return sorted(
+            backends,
+            key=lambda proxy: random.random() ** (1.0 / proxy.weight) if proxy.weight > 0 else 0.0,
+            reverse=True
+        )
+    return list(backends)
+
+def stage_timeout(proxy, remaining, backends_left):
+    """How long to wait on proxy before also asking the next backend"""
+    if STRATEGY == 'hedged':
+        hedge = proxy.latency.percentile(HEDGE_PERCENTILE)
+        if hedge is not None:
+            return min(hedge, remaining)
+    # Split what is left of the budget between the backends still to try
+    return remaining / backends_left
+
+def proxy_to_backends(username, password, nas_ip='127.0.0.1', state=None):
     """
-    if not BACKENDS:
+    Proxy request to the backends according to STRATEGY
+    Return success as soon as ANY backend accepts
+    """
+    if not proxies:
         log(radiusd.L_ERR, "No backends configured")
         return radiusd.RLM_MODULE_FAIL
     
-    results = {}
-    threads = []
-    lock = threading.Lock()
+    # An answer to a challenge goes to the backend that issued it
+    issuer = None
+    if state is not None and challenges is not None:
+        name = challenges.pop(state.lower())
+        issuer = next((proxy for proxy in proxies if proxy.name == name), None)
+    
+    if issuer is not None:
+        backends = [issuer]
+    else:
+        # Skip ejected backends, unless that leaves none to ask
+        backends = [proxy for proxy in proxies if proxy.healthy] or proxies
+    
+    fanout = FanOut(replicas=STRATEGY != 'all' or issuer is not None)
+    submitted = []
+    
+    asked = []
     
-    def check_backend(backend_config):
+    def check_backend(proxy):
         """Thread function to check a single backend"""
-        proxy = BackendProxy(backend_config)
+        try:
+            success, message, reply = proxy.send_request(username, password, nas_ip, fanout, state)
+        finally:
+            proxy.admission.release()
+        fanout.add(proxy.name, success, message, reply)
+        log_backend_result(proxy.name, success, message)
+    
+    def admit(proxy, wait):
+        """
+        Take capacity on the backend; with wait, a backend that queues
+        is waited for until the deadline or a final answer
+        """
+        admission = proxy.admission
+        if admission.try_acquire():
+            return True
+        if admission.mode == 'queue':
+            if not wait:
+                return False
+            METRICS.count(f"backend:{proxy.name}", 'queued')
+            if admission.acquire(deadline - time.monotonic(), fanout.decided):
+                return True
+            if fanout.decided():
+                # Another backend answered while this one was queued for
+                return False
+        admission.skip()
+        METRICS.count(f"backend:{proxy.name}", 'saturated')
+        log(radiusd.L_DBG, f"Backend {proxy.name} saturated, not asked")
+        return False
+    
+    def ask(proxy, wait=True):
+        """Start the request to one backend, False if it was not asked"""
+        if not admit(proxy, wait):
+            return False
         log(radiusd.L_INFO, f"Checking backend: {proxy.name}")
-        
-        success, message, reply = proxy.send_request(username, password, nas_ip)
-        
-        with lock:
-            results[proxy.name] = {
-                'success': success,
-                'message': message,
-                'reply': reply
-            }
-        
-        if success:
-            log(radiusd.L_INFO, f"Backend {proxy.name} returned: {message}")
+        asked.append(proxy)
+        fanout.expect()
+        if loop is not None:
+            # Send from this thread, the loop collects the reply
+            handle = proxy.submit(username, password, nas_ip, fanout, state)
+            if handle is not None:
+                submitted.append((proxy, handle))
+            else:
+                proxy.admission.release()
         else:
-            log(radiusd.L_AUTH, f"Backend {proxy.name} failed: {message}")
+            thread = threading.Thread(target=check_backend, args=(proxy,))
+            thread.daemon = True
+            thread.start()
+        return True
     
-    # Start threads for all backends
-    for backend in BACKENDS:
-        thread = threading.Thread(target=check_backend, args=(backend,))
-        thread.daemon = True
-        thread.start()
-        threads.append(thread)
-    
-    # Wait for all threads to complete or timeout
-    start_time = time.time()
-    for thread in threads:
-        remaining = TIMEOUT - (time.time() - start_time)
-        if remaining > 0:
-            thread.join(timeout=remaining)
-    
-    # Check results - if ANY backend accepted, we accept
-    for backend_name, result in results.items():
-        if result['success']:
-            log(radiusd.L_INFO, f"Authentication accepted by {backend_name}")
-            return radiusd.RLM_MODULE_OK
+    deadline = time.monotonic() + TIMEOUT
+    if STRATEGY == 'all' or issuer is not None:
+        # Ask every backend with capacity, then queue for the saturated
+        # ones that queue; the others were skipped by ask() already
+        queued = [
+            proxy for proxy in backends
+            if not ask(proxy, wait=False) and proxy.admission.mode == 'queue'
+        ]
+        for proxy in queued:
+            if fanout.decided():
+                break
+            ask(proxy)
+    else:
+        # Ask one backend at a time, adding the next whenever the ones
+        # asked so far failed or stayed silent for their stage timeout;
+        # earlier requests stay in flight and may still win
+        order = backend_order(backends)
+        for i, proxy in enumerate(order):
+            if not ask(proxy):
+                continue
+            remaining = deadline - time.monotonic()
+            if i == len(order) - 1 or remaining <= 0:
+                break
+            if fanout.wait(stage_timeout(proxy, remaining, len(order) - i)):
+                break
+    
+    if not asked:
+        log(radiusd.L_ERR, f"All backends saturated, cannot authenticate {username}")
+        return radiusd.RLM_MODULE_FAIL
+    
+    # Wait for a final answer, all backends answering, or the timeout
+    fanout.wait(max(0, deadline - time.monotonic()))
+    fanout.cancel()
+    
+    for proxy, handle in submitted:
+        proxy.collect(handle, fanout)
+        proxy.admission.release()
+    
+    winner = fanout.winner
+    if winner is not None:
+        log(radiusd.L_INFO, f"Authentication accepted by {winner}")
+        reply = reply_attributes(fanout.results[winner]['reply'])
+        if reply:
+            # OK, not UPDATED: authenticate maps UPDATED to Access-Reject
+            return (radiusd.RLM_MODULE_OK, reply, ())
+        return radiusd.RLM_MODULE_OK
+    
+    if fanout.challenged is not None:
+        return challenge(fanout.challenged, fanout.results[fanout.challenged]['reply'], username)
+    
+    if fanout.rejected is not None:
+        log(radiusd.L_AUTH, f"Backend {fanout.rejected} rejected authentication for {username}")
+        reply = reply_attributes(fanout.results[fanout.rejected]['reply'])
+        if reply:
+            return (radiusd.RLM_MODULE_REJECT, reply, ())
+        return radiusd.RLM_MODULE_REJECT
     
     # All backends rejected or failed
     log(radiusd.L_AUTH, f"All backends rejected authentication for {username}")
     return radiusd.RLM_MODULE_REJECT
 
+def challenge(name, reply, username):
+    """
+    Pass an Access-Challenge from backend name on to the NAS, remembering
+    its State so the answer is sent to the same backend
+    """
+    log(radiusd.L_INFO, f"Backend {name} challenged {username}")
+    for state in reply.get(STATE, ()):
+        challenges.put(attribute_value(state), name)
+    return (
+        radiusd.RLM_MODULE_HANDLED,
+        reply_attributes(reply),
+        (('Response-Packet-Type', ':=', 'Access-Challenge'),)
+    )
+
+def start_proxies():
+    """Open the long-lived sockets to every configured backend"""
+    global loop, challenges, inflight, STRATEGY
+
+    if ENGINE == 'loop':
+        loop = ProxyLoop()
+        loop.start()
+    elif ENGINE != 'threads':
+        log(radiusd.L_WARN, f"Unknown engine {ENGINE}, using threads")
+    if STRATEGY not in STRATEGIES:
+        log(radiusd.L_WARN, f"Unknown strategy {STRATEGY}, sending to all backends")
+        STRATEGY = 'all'
+
+    challenges = ChallengeMap(CHALLENGE_TTL)
+    inflight = InFlight() if DEDUP_ATTRIBUTE else None
+    for backend in BACKENDS:
+        proxy = BackendProxy(backend, loop)
+        try:
+            proxy.start()
+        except OSError as e:
+            log(radiusd.L_ERR, f"Cannot open socket to backend {proxy.name}: {str(e)}")
+            continue
+        proxies.append(proxy)
+
+def start_prober():
+    """Start Status-Server probing if configured"""
+    global prober
+
+    backends = [proxy for proxy in proxies if proxy.probe]
+    if PROBE_INTERVAL <= 0 or not backends:
+        return
+
+    prober = StatusProber(backends, PROBE_INTERVAL, PROBE_TIMEOUT)
+    prober.start()
+    log(radiusd.L_INFO, f"Status-Server probing {len(backends)} backends every {PROBE_INTERVAL}s")
+
+def stop_proxies():
+    """Close the sockets to every backend"""
+    global loop, prober
+
+    if prober is not None:
+        prober.stop()
+        prober = None
+    if loop is not None:
+        loop.stop()
+        loop = None
+    while proxies:
+        proxy = proxies.pop()
+        log(radiusd.L_INFO, f"Backend {proxy.name} stats: {proxy.stats()}")
+        proxy.stop()
+
 def instantiate(p):
     """Module instantiation"""
     log(radiusd.L_INFO, "Proxy loadbalance module instantiated")
-    log(radiusd.L_INFO, f"Configured backends: {len(BACKENDS)}")
+    log(radiusd.L_INFO, f"Configured backends: {len(BACKENDS)}, engine: {ENGINE}, strategy: {STRATEGY}")
+    load_dictionary()
+    start_proxies()
+    start_prober()
+    METRICS.start(METRICS_ADDRESS, METRICS_PORT)
     return radiusd.RLM_MODULE_OK
 
+def stats():
+    """Return health, socket and latency stats of every backend"""
+    return {proxy.name: proxy.stats() for proxy in proxies}
+
+@METRICS.timed('authenticate')
 def authenticate(p):
     """Process authentication requests"""
     # Extract attributes from request
-    username = None
-    password = None
-    nas_ip = '127.0.0.1'
-    
-    for attr in p:
-        if attr[0] == 'User-Name':
-            username = attr[1]
-        elif attr[0] == 'User-Password':
-            password = attr[1]
-        elif attr[0] == 'NAS-IP-Address':
-            nas_ip = attr[1]
+    username, password, nas_ip, state, authenticator = REQUEST_ATTRS(p)
     
     if not username or not password:
         log(radiusd.L_AUTH, "Missing username or password")
         return radiusd.RLM_MODULE_INVALID
     
-    # Proxy to backends
-    return proxy_to_backends(username, password, nas_ip)
+    if inflight is None or authenticator is None:
+        return proxy_to_backends(username, password, nas_ip, state)
+
+    # Proxy to backends, once per retransmitted request
+    key = (nas_ip, username, authenticator)
+    return inflight.run(key, 2 * TIMEOUT, proxy_to_backends, username, password, nas_ip, state)
 
 def authorize(p):
     """Process authorization requests"""
@@ -169,5 +1349,7 @@ def accounting(p):
 
 def detach(p):
     """Module detach"""
+    METRICS.stop_server()
+    stop_proxies()
     log(radiusd.L_INFO, "Proxy loadbalance module detached")
     return radiusd.RLM_MODULE_OK
\ No newline at end of file
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Request Attribute Extraction for FreeRADIUS Python modules
+Pulls a declared set of attributes out of a request in a single pass
+"""
+
+
+def attribute_extractor(attributes):
+    """
+    Build a function extracting a fixed set of attributes from a request
+
+    Declare the attributes once at module level, mapping each attribute
+    name to its default:
+
+        AUTH_ATTRS = attribute_extractor({
+            'User-Name': None,
+            'User-Password': None,
+            'NAS-IP-Address': '127.0.0.1',
+        })
+
+    then unpack the values in declaration order:
+
+        username, password, nas_ip = AUTH_ATTRS(p)
+
+    Works with both the rlm_python tuple-of-tuples request and the pair
+    map interface (p.request['User-Name'].value). For tuples the
+    declaration is compiled into the if/elif loop the modules used to
+    write out by hand, returning a plain tuple, so the last occurrence of
+    a repeated attribute wins and no call layer or record is added.
+    """
+    names = list(attributes)
+    defaults = tuple(attributes.values())
+    values = [f"v{i}" for i in range(len(names))]
+
+    def lookup(p):
+        request = getattr(p, 'request', p)
+        found = []
+        for attr, default in zip(names, defaults):
+            try:
+                value = request[attr].value
+            except (KeyError, IndexError, AttributeError):
+                value = None
+            found.append(default if value is None else value)
+        return tuple(found)
+
+    def loop(pairs, name, value):
+        lines = [f"        for {pairs}:"]
+        for i, attr in enumerate(names):
+            lines.append(f"            {'if' if i == 0 else 'elif'} {name} == {attr!r}:")
+            lines.append(f"                {values[i]} = {value}")
+        return lines
+
+    lines = ["def extract(p):"]
+    lines.append("    if p.__class__ is not tuple:")
+    lines.append("        return lookup(p)")
+    lines += [f"    {value} = d{i}" for i, value in enumerate(values)]
+    lines.append("    try:")
+    lines += loop("name, value in p", "name", "value")
+    lines.append("    except ValueError:")
+    lines.append("        # Pairs carrying more than a name and a value")
+    lines += loop("attr in p", "attr[0]", "attr[1]")
+    lines.append(f"    return ({', '.join(values)},)")
+
+    namespace = {f"d{i}": default for i, default in enumerate(defaults)}
+    namespace['lookup'] = lookup
+    exec('\n'.join(lines), namespace)
+    return namespace['extract']
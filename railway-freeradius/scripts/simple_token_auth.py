@@ -9,28 +9,191 @@ import json
 import os
 import time
 import hashlib
-import hmac
 import base64
 import sqlite3
+import struct
+import threading
+import weakref
+from collections import OrderedDict
+from functools import lru_cache
 from pathlib import Path
+from radius_attrs import attribute_extractor
+from radius_metrics import Metrics
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Configuration
-DB_PATH = "/app/data/tokens.db"
+DB_PATH = os.environ.get('TOKEN_DB_PATH', "/app/data/tokens.db")
 VASCO_DEMO_URL = "https://gs.onespan.cloud/te-demotokens/go6"
 
+# SQLite tuning. Each FreeRADIUS thread keeps its own connection for the
+# lifetime of the module; the database runs in WAL mode so lookups never
+# wait for a counter update being committed.
+DB_SYNCHRONOUS = os.environ.get('TOKEN_DB_SYNCHRONOUS', 'NORMAL').upper()
+DB_CACHE_KB = int(os.environ.get('TOKEN_DB_CACHE_KB', '8192'))
+DB_MMAP_BYTES = int(os.environ.get('TOKEN_DB_MMAP_BYTES', str(64 * 1024 * 1024)))
+DB_BUSY_TIMEOUT = float(os.environ.get('TOKEN_DB_BUSY_TIMEOUT', '5'))
+DB_CACHED_STATEMENTS = 32
+
+# In-memory token table: instantiate() loads the tokens table and
+# validation runs against it under per-user locks. Counter advances are
+# written by a background thread in batched transactions; an accept is
+# only returned once its advance is committed, so a used code stays used
+# across restarts. FLUSH_INTERVAL bounds how long an advance waits for
+# others to join its batch.
+MEMORY_TABLE = os.environ.get('TOKEN_MEMORY_TABLE', 'no').lower() in ('1', 'yes', 'true', 'on')
+FLUSH_INTERVAL = float(os.environ.get('TOKEN_FLUSH_INTERVAL', '0'))
+
+# HOTP look-ahead window, and how many tokens keep their decoded key and
+# keyed HMAC state cached
+HOTP_WINDOW = int(os.environ.get('TOKEN_HOTP_WINDOW', '10'))
+KEY_CACHE_SIZE = int(os.environ.get('TOKEN_KEY_CACHE_SIZE', '4096'))
+
+# HOTP resynchronisation, disabled when the window is 0. A code found
+# within RESYNC_WINDOW counters past the look-ahead window is not
+# accepted, but when the user's next code follows it within
+# RESYNC_TIMEOUT seconds the token is resynchronised and logged in.
+RESYNC_WINDOW = int(os.environ.get('TOKEN_RESYNC_WINDOW', '0'))
+RESYNC_TIMEOUT = float(os.environ.get('TOKEN_RESYNC_TIMEOUT', '300'))
+
+# TOTP defaults for tokens leaving step or skew NULL: seconds per time
+# step, and how many steps either side of now are still accepted
+TOTP_STEP = int(os.environ.get('TOKEN_TOTP_STEP', '30'))
+TOTP_SKEW = int(os.environ.get('TOKEN_TOTP_SKEW', '1'))
+
+# HMAC algorithms a token may use (RFC 6238)
+DIGESTS = ('sha1', 'sha256', 'sha512')
+
+# Columns added to tokens after the first release, with their types;
+# NULL means the default above. For TOTP tokens counter holds the first
+# time step not used yet.
+TOKEN_COLUMNS = (
+    ('digits', 'INTEGER'),
+    ('digest', 'TEXT'),
+    ('step', 'INTEGER'),
+    ('skew', 'INTEGER')
+)
+
+# Optional Prometheus metrics listener, disabled when no port is set
+METRICS_ADDRESS = os.environ.get('TOKEN_METRICS_ADDRESS', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('TOKEN_METRICS_PORT', '0'))
+
+METRICS = Metrics('simple_token_auth')
+
+# Request attributes used by authenticate()
+REQUEST_ATTRS = attribute_extractor({
+    'User-Name': None,
+    'User-Password': None
+})
+
+# In-memory token table, only set when MEMORY_TABLE is enabled
+token_table = None
+
+# Users half way through a resync: username -> (counter, expiry)
+resyncs = {}
+resyncs_lock = threading.Lock()
+
+# Per-thread database connection, see get_connection()
+local = threading.local()
+
+# Every open connection, so detach() can close them; connections made
+# before the last close_connections() are replaced on next use
+connections = []
+connections_lock = threading.Lock()
+generation = 0
+
+class ConnectionOwner:
+    """
+    Kept in thread-local storage next to a thread's connection; it is
+    collected when the thread exits, which closes the connection
+    """
+    __slots__ = ('__weakref__',)
+
 def log(level, msg):
     """Log messages to FreeRADIUS log"""
     radiusd.radlog(level, f"simple_token_auth: {msg}")
 
+def open_connection():
+    """Open a tuned connection to the token database"""
+    if DB_SYNCHRONOUS not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+        raise ValueError(f"Bad TOKEN_DB_SYNCHRONOUS {DB_SYNCHRONOUS}")
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=DB_BUSY_TIMEOUT,
+        cached_statements=DB_CACHED_STATEMENTS,
+        # Closed by detach() from another thread
+        check_same_thread=False
+    )
+    conn.execute(f'PRAGMA synchronous = {DB_SYNCHRONOUS}')
+    conn.execute(f'PRAGMA cache_size = {-DB_CACHE_KB}')
+    conn.execute(f'PRAGMA mmap_size = {DB_MMAP_BYTES}')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    return conn
+
+def get_connection():
+    """Return the connection of the calling thread, opening it on first use"""
+    conn = getattr(local, 'conn', None)
+    if conn is not None and local.generation == generation:
+        return conn
+
+    conn = open_connection()
+    with connections_lock:
+        connections.append(conn)
+        local.generation = generation
+    owner = ConnectionOwner()
+    local.retire = weakref.finalize(owner, retire_connection, conn)
+    local.owner = owner
+    local.conn = conn
+    return conn
+
+def retire_connection(conn):
+    """Forget and close the connection of a thread that is done with it"""
+    with connections_lock:
+        if conn in connections:
+            connections.remove(conn)
+    try:
+        conn.close()
+    except sqlite3.Error:
+        pass
+
+def drop_connection():
+    """Close the connection of the calling thread after an error"""
+    if getattr(local, 'conn', None) is None:
+        return
+    local.conn = None
+    local.retire()
+
+def close_connections():
+    """Close the connections of every thread"""
+    global generation
+
+    with connections_lock:
+        generation += 1
+        closing = list(connections)
+        connections.clear()
+    for conn in closing:
+        try:
+            conn.close()
+        except sqlite3.Error as e:
+            log(radiusd.L_WARN, f"Closing database connection failed: {str(e)}")
+
 def init_database():
     """Initialize SQLite database for tokens"""
     try:
         # Ensure directory exists
         Path(DB_PATH).parent.mkdir(parents=True, exist_ok=True)
         
-        conn = sqlite3.connect(DB_PATH)
+        conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT)
         cursor = conn.cursor()
         
+        # WAL is a property of the database file, set once here
+        mode = cursor.execute('PRAGMA journal_mode = WAL').fetchone()[0]
+        if mode.lower() != 'wal':
+            log(radiusd.L_WARN, f"Token database stays in {mode} journal mode")
+        
         # Create tokens table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS tokens (
@@ -39,15 +202,27 @@ def init_database():
                 token_type TEXT NOT NULL,
                 secret TEXT NOT NULL,
                 counter INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                digits INTEGER,
+                digest TEXT,
+                step INTEGER,
+                skew INTEGER
             )
         ''')
         
+        # Add the columns a database from an older release lacks
+        columns = {row[1] for row in cursor.execute('PRAGMA table_info(tokens)')}
+        for name, kind in TOKEN_COLUMNS:
+            if name not in columns:
+                cursor.execute(f'ALTER TABLE tokens ADD COLUMN {name} {kind}')
+                log(radiusd.L_INFO, f"Added column {name} to tokens")
+        
         # Create demo tokens if they don't exist
         demo_tokens = [
             ('demo', 'hotp', '3132333435363738393031323334353637383930', 0),
             ('vasco_demo', 'hotp', '76617363615f64656d6f5f746f6b656e5f736563726574', 0),
-            ('testuser', 'hotp', '746573745f746f6b656e5f736563726574', 0)
+            ('testuser', 'hotp', '746573745f746f6b656e5f736563726574', 0),
+            ('totp_demo', 'totp', '3132333435363738393031323334353637383930', 0)
         ]
         
         for username, token_type, secret, counter in demo_tokens:
@@ -65,67 +240,484 @@ def init_database():
         log(radiusd.L_ERR, f"Database initialization failed: {str(e)}")
         return False
 
-def hotp(secret, counter, digits=6):
+# RFC 2104 inner and outer pad translations
+IPAD = bytes(x ^ 0x36 for x in range(256))
+OPAD = bytes(x ^ 0x5c for x in range(256))
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def hmac_key(secret, digest='sha1'):
+    """
+    Inner and outer HMAC hash states keyed with the hex secret
+    Callers copy() them, so the key is decoded and the pads are hashed
+    once per token instead of once per counter.
+    """
+    if digest not in DIGESTS:
+        raise ValueError(f"Unsupported digest {digest}")
+    key = bytes.fromhex(secret)
+    block_size = hashlib.new(digest).block_size
+    if len(key) > block_size:
+        key = hashlib.new(digest, key).digest()
+    key = key.ljust(block_size, b'\0')
+    return hashlib.new(digest, key.translate(IPAD)), hashlib.new(digest, key.translate(OPAD))
+
+def hmac_digest(key, message):
+    """HMAC of message from the states returned by hmac_key()"""
+    inner = key[0].copy()
+    inner.update(message)
+    outer = key[1].copy()
+    outer.update(inner.digest())
+    return outer.digest()
+
+def truncate(hmac_result, digits):
+    """RFC 4226 dynamic truncation to a code of digits"""
+    offset = hmac_result[-1] & 0x0f
+    code = ((hmac_result[offset] & 0x7f) << 24) | \
+           ((hmac_result[offset + 1] & 0xff) << 16) | \
+           ((hmac_result[offset + 2] & 0xff) << 8) | \
+           (hmac_result[offset + 3] & 0xff)
+    otp = code % (10 ** digits)
+    return str(otp).zfill(digits)
+
+def hotp(secret, counter, digits=6, digest='sha1'):
     """Generate HOTP token"""
     try:
-        # Convert hex secret to bytes
-        key = bytes.fromhex(secret)
-        
-        # Convert counter to bytes
-        counter_bytes = counter.to_bytes(8, byteorder='big')
-        
-        # Generate HMAC-SHA1
-        hmac_result = hmac.new(key, counter_bytes, hashlib.sha1).digest()
-        
-        # Dynamic truncation
-        offset = hmac_result[-1] & 0x0f
-        code = ((hmac_result[offset] & 0x7f) << 24) | \
-               ((hmac_result[offset + 1] & 0xff) << 16) | \
-               ((hmac_result[offset + 2] & 0xff) << 8) | \
-               (hmac_result[offset + 3] & 0xff)
-        
-        # Generate digits
-        otp = code % (10 ** digits)
-        return str(otp).zfill(digits)
+        return truncate(hmac_digest(hmac_key(secret, digest), counter.to_bytes(8, byteorder='big')), digits)
         
     except Exception as e:
         log(radiusd.L_ERR, f"HOTP generation failed: {str(e)}")
         return None
 
+COUNTER = struct.Struct('>Q')
+
+def hotp_codes(secret, start, count, digits=6, digest='sha1'):
+    """
+    Codes of counters start to start + count - 1, as integers
+    The HMACs are computed in a tight loop; with NumPy the dynamic
+    truncation and modulo then run on the whole batch at once, and an
+    array is returned instead of a list.
+    """
+    inner_key, outer_key = hmac_key(secret, digest)
+    pack = COUNTER.pack
+    macs = []
+    append = macs.append
+    for counter in range(start, start + count):
+        inner = inner_key.copy()
+        inner.update(pack(counter))
+        outer = outer_key.copy()
+        outer.update(inner.digest())
+        append(outer.digest())
+    modulo = 10 ** digits
+
+    if numpy is None:
+        return [(int.from_bytes(mac[mac[-1] & 0x0f:(mac[-1] & 0x0f) + 4], 'big') & 0x7fffffff) % modulo
+                for mac in macs]
+
+    matrix = numpy.frombuffer(b''.join(macs), dtype=numpy.uint8).reshape(count, outer_key.digest_size)
+    offsets = (matrix[:, -1] & 0x0f).astype(numpy.intp)
+    words = matrix[numpy.arange(count)[:, None], offsets[:, None] + numpy.arange(4)].astype(numpy.uint64)
+    codes = ((words[:, 0] & 0x7f) << 24) | (words[:, 1] << 16) | (words[:, 2] << 8) | words[:, 3]
+    return codes % numpy.uint64(modulo)
+
+def find_code(secret, start, count, password, digits=6, digest='sha1'):
+    """Return how far past start password is within count counters, or None"""
+    if len(password) != digits or not password.isdigit() or count <= 0:
+        return None
+    codes = hotp_codes(secret, start, count, digits, digest)
+    target = int(password)
+    if numpy is None:
+        try:
+            return codes.index(target)
+        except ValueError:
+            return None
+    hits = numpy.flatnonzero(codes == target)
+    return int(hits[0]) if len(hits) else None
+
+def resync_counter(username, token, password):
+    """
+    Second half of a resync: return the counter to store if password
+    follows the code seen last, else remember where password was found
+    """
+    now = time.monotonic()
+    with resyncs_lock:
+        pending = resyncs.pop(username, None)
+    if pending is not None and pending[1] > now and pending[0] >= token.counter:
+        if hotp(token.secret, pending[0], token.digits, token.digest) == password:
+            log(radiusd.L_INFO, f"HOTP token of {username} resynchronised at counter {pending[0]}")
+            return pending[0] + 1
+
+    start = token.counter + HOTP_WINDOW
+    offset = find_code(token.secret, start, RESYNC_WINDOW, password, token.digits, token.digest)
+    if offset is not None:
+        with resyncs_lock:
+            resyncs[username] = (start + offset + 1, now + RESYNC_TIMEOUT)
+        log(radiusd.L_AUTH, f"HOTP of {username} is {HOTP_WINDOW + offset} counters ahead, "
+            f"waiting for the next code to resync")
+    return None
+
+def hotp_window(secret, counter, password, window=None, digits=6, digest='sha1'):
+    """Return how far ahead of counter password is, or None"""
+    if window is None:
+        window = HOTP_WINDOW
+    if len(password) != digits or not password.isdigit():
+        return None
+    try:
+        key = hmac_key(secret, digest)
+    except ValueError as e:
+        log(radiusd.L_ERR, f"HOTP generation failed: {str(e)}")
+        return None
+    for i in range(window):
+        if truncate(hmac_digest(key, (counter + i).to_bytes(8, byteorder='big')), digits) == password:
+            return i
+    return None
+
+class TotpWindow:
+    """
+    Expected codes of one TOTP token for the steps around now
+
+    Refreshed once per time step, reusing the codes of the steps still
+    in range, so checking a code is a dictionary lookup however wide
+    the skew window is.
+    """
+
+    __slots__ = ('current', 'by_step', 'codes', 'lock')
+
+    def __init__(self):
+        self.current = None
+        self.by_step = {}
+        # code -> time steps producing it, in ascending order
+        self.codes = {}
+        self.lock = threading.Lock()
+
+    def lookup(self, token, current):
+        """Return the time steps token produces password for"""
+        if self.current != current:
+            with self.lock:
+                if self.current != current:
+                    self._refresh(token, current)
+        return self.codes
+
+    def _refresh(self, token, current):
+        key = hmac_key(token.secret, token.digest)
+        by_step = {}
+        codes = {}
+        for step in range(current - token.skew, current + token.skew + 1):
+            code = self.by_step.get(step)
+            if code is None:
+                code = truncate(hmac_digest(key, step.to_bytes(8, byteorder='big')), token.digits)
+            by_step[step] = code
+            codes.setdefault(code, []).append(step)
+        self.by_step = by_step
+        self.codes = codes
+        self.current = current
+
+# TOTP windows by token, least recently used first
+totp_windows = OrderedDict()
+totp_windows_lock = threading.Lock()
+
+def totp_window(username, token):
+    """Return the TotpWindow of a token, creating it on first use"""
+    key = (username, token.secret, token.digest, token.digits, token.step, token.skew)
+    with totp_windows_lock:
+        window = totp_windows.get(key)
+        if window is None:
+            window = totp_windows[key] = TotpWindow()
+            if len(totp_windows) > KEY_CACHE_SIZE:
+                totp_windows.popitem(last=False)
+        else:
+            totp_windows.move_to_end(key)
+    return window
+
+def totp_match(username, token, password, now=None):
+    """Return the first unused time step password belongs to, or None"""
+    if len(password) != token.digits or not password.isdigit():
+        return None
+    current = int(time.time() if now is None else now) // token.step
+    for step in totp_window(username, token).lookup(token, current).get(password, ()):
+        if step >= token.counter:
+            return step
+    return None
+
+class TokenEntry:
+    """One token, as read from the tokens table"""
+
+    __slots__ = ('token_type', 'secret', 'counter', 'digits', 'digest', 'step', 'skew', 'lock')
+
+    # Columns to select, in constructor order
+    COLUMNS = 'token_type, secret, counter, digits, digest, step, skew'
+
+    def __init__(self, token_type, secret, counter, digits=None, digest=None, step=None, skew=None):
+        self.token_type = token_type
+        self.secret = secret
+        self.counter = counter
+        self.digits = digits or 6
+        self.digest = (digest or 'sha1').lower()
+        self.step = step or TOTP_STEP
+        self.skew = TOTP_SKEW if skew is None else skew
+        self.lock = threading.Lock()
+
+def next_counter(username, token, password):
+    """
+    Return the counter to store once password is accepted, or None if
+    it does not match the token
+    """
+    if token.token_type == 'hotp':
+        offset = hotp_window(token.secret, token.counter, password, digits=token.digits, digest=token.digest)
+        if offset is not None:
+            return token.counter + offset + 1
+        if RESYNC_WINDOW > 0:
+            return resync_counter(username, token, password)
+        return None
+    if token.token_type == 'totp':
+        step = totp_match(username, token, password)
+        return None if step is None else step + 1
+    log(radiusd.L_ERR, f"Unknown token type {token.token_type} for {username}")
+    return None
+
+class Flush:
+    """Completion of one queued counter advance"""
+
+    __slots__ = ('done', 'ok')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.ok = False
+
+    def wait(self, timeout):
+        """True once the advance is committed"""
+        return self.done.wait(timeout) and self.ok
+
+class CounterWriter:
+    """
+    Background writer persisting counter advances
+
+    Advances queued while a transaction is being committed all go into
+    the next one, so concurrent accepts share a single commit. The
+    writer's connection runs with synchronous=FULL: that cost is paid
+    once per batch, and a committed advance survives a power loss.
+    """
+
+    def __init__(self, interval=0.0):
+        self.interval = interval
+        # username -> highest counter queued
+        self.pending = {}
+        self.flushes = []
+        self.stopping = False
+        self.cond = threading.Condition()
+        self.thread = None
+        self.batches = 0
+        self.written = 0
+
+    def start(self):
+        """Start the writer thread"""
+        self.thread = threading.Thread(target=self._run, name='simple_token_auth-writer', daemon=True)
+        self.thread.start()
+
+    def submit(self, username, counter):
+        """Queue a counter advance, returning its Flush"""
+        flush = Flush()
+        with self.cond:
+            if self.stopping:
+                flush.done.set()
+                return flush
+            if counter > self.pending.get(username, -1):
+                self.pending[username] = counter
+            self.flushes.append(flush)
+            self.cond.notify()
+        return flush
+
+    def stop(self, timeout=None):
+        """Write what is queued and stop the writer"""
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def _run(self):
+        conn = None
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending or self.stopping)
+                stopping = self.stopping
+            if self.interval and not stopping:
+                # Let more advances join this batch
+                time.sleep(self.interval)
+            with self.cond:
+                batch, self.pending = self.pending, {}
+                flushes, self.flushes = self.flushes, []
+            if batch:
+                if conn is None:
+                    conn = self._connect()
+                ok = conn is not None and self._write(conn, batch)
+                if not ok and conn is not None:
+                    conn.close()
+                    conn = None
+                for flush in flushes:
+                    flush.ok = ok
+                    flush.done.set()
+            elif stopping:
+                break
+        if conn is not None:
+            conn.close()
+
+    def _connect(self):
+        try:
+            conn = open_connection()
+            conn.execute('PRAGMA synchronous = FULL')
+            return conn
+        except (sqlite3.Error, ValueError) as e:
+            log(radiusd.L_ERR, f"Counter writer cannot open the token database: {str(e)}")
+            return None
+
+    def _write(self, conn, batch):
+        try:
+            with conn:
+                conn.executemany(
+                    'UPDATE tokens SET counter = ? WHERE username = ? AND counter < ?',
+                    [(counter, username, counter) for username, counter in batch.items()]
+                )
+        except sqlite3.Error as e:
+            log(radiusd.L_ERR, f"Writing {len(batch)} token counters failed: {str(e)}")
+            return False
+        self.batches += 1
+        self.written += len(batch)
+        return True
+
+class TokenTable:
+    """
+    The tokens table held in memory
+
+    Users missing from the table are looked up in the database once, so
+    tokens enrolled after instantiate() are picked up; changes to
+    existing tokens need a reload (HUP).
+    """
+
+    def __init__(self, writer):
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.writer = writer
+
+    def load(self, conn):
+        """Read every token into the table"""
+        entries = {
+            row[0]: TokenEntry(*row[1:])
+            for row in conn.execute(f'SELECT username, {TokenEntry.COLUMNS} FROM tokens')
+        }
+        with self.lock:
+            self.entries = entries
+        return len(entries)
+
+    def entry(self, username):
+        """Return the TokenEntry of username, or None"""
+        entry = self.entries.get(username)
+        if entry is not None:
+            return entry
+
+        result = get_connection().execute(
+            f'SELECT {TokenEntry.COLUMNS} FROM tokens WHERE username = ?', (username,)
+        ).fetchone()
+        if result is None:
+            return None
+        with self.lock:
+            return self.entries.setdefault(username, TokenEntry(*result))
+
+    def validate(self, username, password):
+        """Validate password, persisting the counter advance on success"""
+        entry = self.entry(username)
+        if entry is None:
+            log(radiusd.L_AUTH, f"User {username} not found in token database")
+            return False
+
+        with entry.lock:
+            counter = next_counter(username, entry, password)
+            if counter is None:
+                log(radiusd.L_AUTH, f"Token validation failed for {username}")
+                return False
+            # Advancing in memory first rejects concurrent replays
+            entry.counter = counter
+            flush = self.writer.submit(username, counter)
+
+        if not flush.wait(2 * DB_BUSY_TIMEOUT):
+            log(radiusd.L_ERR, f"Counter for {username} could not be saved, rejecting")
+            return False
+        log(radiusd.L_INFO, f"{entry.token_type.upper()} validation successful for {username}")
+        return True
+
+def start_token_table():
+    """Load the in-memory token table and start its writer"""
+    global token_table
+
+    writer = CounterWriter(FLUSH_INTERVAL)
+    table = TokenTable(writer)
+    count = table.load(get_connection())
+    writer.start()
+    token_table = table
+    log(radiusd.L_INFO, f"Loaded {count} tokens into memory")
+
+def stop_token_table():
+    """Flush queued counter advances and drop the table"""
+    global token_table
+
+    if token_table is None:
+        return
+    writer = token_table.writer
+    token_table = None
+    writer.stop()
+    log(radiusd.L_INFO, f"Counter writer stopped after {writer.batches} batches, "
+        f"{writer.written} counters")
+
 def validate_token(username, password):
     """Validate token against database"""
+    if token_table is not None:
+        try:
+            return token_table.validate(username, password)
+        except sqlite3.Error as e:
+            drop_connection()
+            log(radiusd.L_ERR, f"Token validation error: {str(e)}")
+            return False
+        except Exception as e:
+            # A bad digest or secret, rejected as in the database branch
+            log(radiusd.L_ERR, f"Token validation error: {str(e)}")
+            return False
+
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
+        conn = get_connection()
         
         # Get user token info
-        cursor.execute('SELECT token_type, secret, counter FROM tokens WHERE username = ?', (username,))
-        result = cursor.fetchone()
+        result = conn.execute(
+            f'SELECT {TokenEntry.COLUMNS} FROM tokens WHERE username = ?', (username,)
+        ).fetchone()
         
         if not result:
             log(radiusd.L_AUTH, f"User {username} not found in token database")
-            conn.close()
             return False
         
-        token_type, secret, counter = result
+        token = TokenEntry(*result)
         
-        if token_type == 'hotp':
-            # Check current counter and next few values (sync window)
-            for i in range(10):  # Check 10 values ahead
-                expected_otp = hotp(secret, counter + i)
-                if expected_otp and expected_otp == password:
-                    # Update counter
-                    cursor.execute('UPDATE tokens SET counter = ? WHERE username = ?', 
-                                 (counter + i + 1, username))
-                    conn.commit()
-                    conn.close()
-                    log(radiusd.L_INFO, f"HOTP validation successful for {username}")
-                    return True
+        # Check the HOTP sync window or the TOTP steps around now
+        counter = next_counter(username, token, password)
+        if counter is not None:
+            # Advance the counter unless another thread already
+            # used this or a later code
+            with conn:
+                updated = conn.execute(
+                    'UPDATE tokens SET counter = ? WHERE username = ? AND counter <= ?',
+                    (counter, username, counter - 1)
+                ).rowcount
+            if not updated:
+                log(radiusd.L_AUTH, f"{token.token_type.upper()} for {username} was used concurrently")
+                return False
+            log(radiusd.L_INFO, f"{token.token_type.upper()} validation successful for {username}")
+            return True
         
-        conn.close()
         log(radiusd.L_AUTH, f"Token validation failed for {username}")
         return False
         
+    except sqlite3.Error as e:
+        drop_connection()
+        log(radiusd.L_ERR, f"Token validation error: {str(e)}")
+        return False
     except Exception as e:
         log(radiusd.L_ERR, f"Token validation error: {str(e)}")
         return False
@@ -133,31 +725,34 @@ def validate_token(username, password):
 def instantiate(p):
     """Module instantiation"""
     log(radiusd.L_INFO, "Simple token auth module instantiated")
-    if init_database():
-        log(radiusd.L_INFO, "Token database ready")
-        return radiusd.RLM_MODULE_OK
-    else:
+    METRICS.start(METRICS_ADDRESS, METRICS_PORT)
+    if not init_database():
         log(radiusd.L_ERR, "Failed to initialize token database")
         return radiusd.RLM_MODULE_FAIL
 
+    if MEMORY_TABLE:
+        try:
+            start_token_table()
+        except (sqlite3.Error, ValueError) as e:
+            log(radiusd.L_ERR, f"Loading tokens into memory failed: {str(e)}")
+            return radiusd.RLM_MODULE_FAIL
+    log(radiusd.L_INFO, "Token database ready")
+    return radiusd.RLM_MODULE_OK
+
+@METRICS.timed('authenticate')
 def authenticate(p):
     """Process authentication requests"""
     # Extract username and password from request
-    username = None
-    password = None
-    
-    for attr in p:
-        if attr[0] == 'User-Name':
-            username = attr[1]
-        elif attr[0] == 'User-Password':
-            password = attr[1]
+    username, password = REQUEST_ATTRS(p)
     
     if not username or not password:
         log(radiusd.L_AUTH, "Missing username or password")
         return radiusd.RLM_MODULE_INVALID
     
     # Validate token
-    if validate_token(username, password):
+    with METRICS.timer('validate_token'):
+        valid = validate_token(username, password)
+    if valid:
         return radiusd.RLM_MODULE_OK
     else:
         return radiusd.RLM_MODULE_REJECT
@@ -176,6 +771,9 @@ def accounting(p):
 
 def detach(p):
     """Module detach"""
+    METRICS.stop_server()
+    stop_token_table()
+    close_connections()
     log(radiusd.L_INFO, "Simple token auth module detached")
     return radiusd.RLM_MODULE_OK
 
@@ -0,0 +1,30 @@
+"""
+Shared helpers for the Python module tests
+Loads the FreeRADIUS Python modules outside the server, with the
+simulator's stand-in radiusd module in place
+"""
+
+import importlib.util
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS = os.path.join(HERE, '..', 'scripts')
+SERVICE_SCRIPTS = os.path.join(HERE, '..', '..', 'freeradius-service', 'scripts')
+
+sys.path.insert(0, os.path.join(HERE, '..', 'bench'))
+sys.path.insert(0, SCRIPTS)
+
+from radius_sim import install_radiusd_stub  # noqa: E402
+
+if 'radiusd' not in sys.modules:
+    install_radiusd_stub()
+
+
+def load(directory, name):
+    """Import a fresh copy of directory/name.py under its own name"""
+    spec = importlib.util.spec_from_file_location(
+        f"{name}_{abs(hash(directory))}", os.path.join(directory, f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,158 @@
+"""
+Tests for circuit_breaker.CircuitBreaker, run against both copies
+"""
+
+import unittest
+from unittest import mock
+
+from support import SCRIPTS, SERVICE_SCRIPTS, load
+
+
+class Clock:
+    """Hand-driven stand-in for time.monotonic()"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class CircuitBreakerTests:
+    DIRECTORY = None
+
+    def setUp(self):
+        self.module = load(self.DIRECTORY, 'circuit_breaker')
+        self.clock = Clock()
+        patcher = mock.patch.object(self.module.time, 'monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = self.module.CircuitBreaker(
+            'test', window=30, min_requests=4, error_rate=0.5,
+            timeout_rate=0.5, open_interval=10)
+
+    def call(self, outcome):
+        ticket = self.breaker.allow()
+        self.assertIsNotNone(ticket)
+        self.breaker.record(ticket, outcome)
+
+    def trip(self):
+        B = self.module.CircuitBreaker
+        for outcome in (B.SUCCESS, B.SUCCESS, B.ERROR, B.ERROR):
+            self.call(outcome)
+        self.assertEqual(self.breaker.state, B.OPEN)
+
+    def test_closed_allows_and_stays_closed_below_threshold(self):
+        B = self.module.CircuitBreaker
+        for outcome in (B.SUCCESS, B.SUCCESS, B.SUCCESS, B.ERROR):
+            self.call(outcome)
+        self.assertEqual(self.breaker.state, B.CLOSED)
+        self.assertEqual(self.breaker.stats()['errors'], 1)
+
+    def test_closed_needs_min_requests(self):
+        B = self.module.CircuitBreaker
+        for _ in range(3):
+            self.call(B.ERROR)
+        self.assertEqual(self.breaker.state, B.CLOSED)
+
+    def test_closed_opens_on_timeout_rate(self):
+        B = self.module.CircuitBreaker
+        for outcome in (B.SUCCESS, B.SUCCESS, B.TIMEOUT, B.TIMEOUT):
+            self.call(outcome)
+        self.assertEqual(self.breaker.state, B.OPEN)
+
+    def test_closed_window_expires_old_samples(self):
+        B = self.module.CircuitBreaker
+        self.call(B.ERROR)
+        self.call(B.ERROR)
+        self.clock.now += 31
+        for _ in range(4):
+            self.call(B.SUCCESS)
+        self.assertEqual(self.breaker.state, B.CLOSED)
+        self.assertEqual(self.breaker.stats()['errors'], 0)
+
+    def test_open_fails_fast(self):
+        self.trip()
+        self.clock.now += 5
+        self.assertIsNone(self.breaker.allow())
+        self.assertEqual(self.breaker.stats()['fast_failed'], 1)
+
+    def test_open_ignores_late_replies(self):
+        B = self.module.CircuitBreaker
+        late = self.breaker.allow()
+        self.trip()
+        self.breaker.record(late, B.SUCCESS)
+        self.assertEqual(self.breaker.state, B.OPEN)
+
+    def test_half_open_lets_one_probe_through(self):
+        B = self.module.CircuitBreaker
+        self.trip()
+        self.clock.now += 10
+        self.assertIsNotNone(self.breaker.allow())
+        self.assertEqual(self.breaker.state, B.HALF_OPEN)
+        self.assertIsNone(self.breaker.allow())
+
+    def test_half_open_probe_success_closes(self):
+        B = self.module.CircuitBreaker
+        self.trip()
+        self.clock.now += 10
+        self.call(B.SUCCESS)
+        self.assertEqual(self.breaker.state, B.CLOSED)
+        self.assertEqual(self.breaker.stats()['requests'], 0)
+
+    def test_half_open_probe_failure_reopens(self):
+        B = self.module.CircuitBreaker
+        self.trip()
+        self.clock.now += 10
+        self.call(B.TIMEOUT)
+        self.assertEqual(self.breaker.state, B.OPEN)
+        self.assertIsNone(self.breaker.allow())
+
+    def test_half_open_ignores_outcomes_other_than_the_probe(self):
+        B = self.module.CircuitBreaker
+        late = self.breaker.allow()
+        self.trip()
+        self.clock.now += 10
+        probe = self.breaker.allow()
+        self.breaker.record(late, B.SUCCESS)
+        self.assertEqual(self.breaker.state, B.HALF_OPEN)
+        self.breaker.record(late, B.ERROR)
+        self.assertEqual(self.breaker.state, B.HALF_OPEN)
+        self.breaker.record(probe, B.SUCCESS)
+        self.assertEqual(self.breaker.state, B.CLOSED)
+
+    def test_half_open_replaces_a_stuck_probe(self):
+        B = self.module.CircuitBreaker
+        self.trip()
+        self.clock.now += 10
+        stuck = self.breaker.allow()
+        self.clock.now += 10
+        probe = self.breaker.allow()
+        self.assertIsNotNone(probe)
+        self.breaker.record(stuck, B.SUCCESS)
+        self.assertEqual(self.breaker.state, B.HALF_OPEN)
+        self.breaker.record(probe, B.ERROR)
+        self.assertEqual(self.breaker.state, B.OPEN)
+
+    def test_closed_ignores_replies_from_before_it_opened(self):
+        B = self.module.CircuitBreaker
+        late = [self.breaker.allow() for _ in range(4)]
+        self.trip()
+        self.clock.now += 10
+        self.call(B.SUCCESS)
+        for ticket in late:
+            self.breaker.record(ticket, B.ERROR)
+        self.assertEqual(self.breaker.state, B.CLOSED)
+        self.assertEqual(self.breaker.stats()['requests'], 0)
+
+
+class RailwayCircuitBreakerTests(CircuitBreakerTests, unittest.TestCase):
+    DIRECTORY = SCRIPTS
+
+
+class ServiceCircuitBreakerTests(CircuitBreakerTests, unittest.TestCase):
+    DIRECTORY = SERVICE_SCRIPTS
+
+
+if __name__ == '__main__':
+    unittest.main()
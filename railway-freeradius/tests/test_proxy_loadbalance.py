@@ -0,0 +1,114 @@
+"""
+Tests for the backend sockets of proxy_loadbalance
+"""
+
+import hashlib
+import os
+import socket
+import struct
+import unittest
+
+from support import SCRIPTS, load
+
+SECRET = b'testing123'
+
+
+def reply_packet(code, ident, authenticator, attributes=b''):
+    """Encode a backend reply to the request sent with authenticator"""
+    header = struct.pack('!BBH', code, ident, 20 + len(attributes))
+    digest = hashlib.md5(header + authenticator + attributes + SECRET).digest()
+    return header + digest + attributes
+
+
+class BackendSocketTests:
+    ENGINE = None
+
+    def setUp(self):
+        self.module = load(SCRIPTS, 'proxy_loadbalance')
+        self.backend = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.backend.bind(('127.0.0.1', 0))
+        self.backend.settimeout(2)
+        self.addCleanup(self.backend.close)
+        loop = None
+        if self.ENGINE == 'loop':
+            loop = self.module.ProxyLoop()
+            loop.start()
+            self.addCleanup(loop.stop)
+        self.sock = self.module.BackendSocket(
+            '127.0.0.1', self.backend.getsockname()[1], SECRET, 'test', loop)
+        self.addCleanup(self.sock.close)
+
+    def exchange(self, code=2, attributes=b'', callback=None):
+        """Send a request through the socket, answer it from the backend"""
+        ident = self.sock.reserve()
+        authenticator = os.urandom(16)
+        pending = self.sock.send(ident, b'request', authenticator, callback=callback)
+        _, address = self.backend.recvfrom(4096)
+        self.backend.sendto(reply_packet(code, ident, authenticator, attributes), address)
+        self.assertTrue(pending.done.wait(2))
+        self.sock.release(ident)
+        return pending.reply
+
+    def test_reply_reaches_the_request(self):
+        reply = self.exchange()
+        self.assertEqual(reply.code, 2)
+        self.assertEqual(self.sock.stray, 0)
+
+    def test_raising_callback_keeps_the_reader(self):
+        def callback(reply):
+            raise RuntimeError('callback failed')
+
+        self.exchange(callback=callback)
+        self.assertEqual(self.sock.stray, 1)
+        self.assertEqual(self.exchange().code, 2)
+
+    def test_reply_without_dictionary(self):
+        self.assertIsNone(self.module.DICTIONARY)
+        state = struct.pack('!BB', 24, 6) + b'abcd'
+        message = struct.pack('!BB', 18, 7) + b'hello'
+        vendor = struct.pack('!BBLBB', 26, 12, 9, 1, 6) + b'xyzw'
+        reply = self.exchange(11, state + message + vendor)
+        self.assertEqual(reply.code, 11)
+        self.assertEqual(self.sock.stray, 0)
+        self.assertEqual(self.module.reply_attributes(reply), (('State', ':=', '0x61626364'),))
+
+
+class AdmissionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.module = load(SCRIPTS, 'proxy_loadbalance')
+        self.backend = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.backend.bind(('127.0.0.1', 0))
+        self.addCleanup(self.backend.close)
+        self.module.TIMEOUT = 1
+        self.module.BACKENDS = [{
+            'host': '127.0.0.1',
+            'port': self.backend.getsockname()[1],
+            'secret': SECRET.decode(),
+            'name': 'busy',
+            'max_inflight': 1
+        }]
+        self.module.start_proxies()
+        self.addCleanup(self.module.stop_proxies)
+
+    def test_saturated_backend_is_skipped_once(self):
+        admission = self.module.proxies[0].admission
+        self.assertTrue(admission.try_acquire())
+        result = self.module.proxy_to_backends('bob', 'secret')
+        self.assertEqual(result, self.module.radiusd.RLM_MODULE_FAIL)
+        self.assertEqual(admission.snapshot()['skipped'], 1)
+        self.assertEqual(admission.snapshot()['queued'], 0)
+        results = self.module.METRICS.snapshot()[1]
+        self.assertEqual(results[('backend:busy', 'saturated')], 1)
+
+
+class ThreadsBackendSocketTests(BackendSocketTests, unittest.TestCase):
+    ENGINE = 'threads'
+
+
+class LoopBackendSocketTests(BackendSocketTests, unittest.TestCase):
+    ENGINE = 'loop'
+
+
+if __name__ == '__main__':
+    unittest.main()
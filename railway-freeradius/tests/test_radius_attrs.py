@@ -0,0 +1,59 @@
+"""
+Tests for radius_attrs.attribute_extractor(), run against both copies
+"""
+
+import unittest
+
+from support import SCRIPTS, SERVICE_SCRIPTS, load
+
+
+class Pair:
+    def __init__(self, value):
+        self.value = value
+
+
+class PairMap:
+    def __init__(self, attrs):
+        self.request = {name: Pair(value) for name, value in attrs}
+
+
+class AttributeExtractorTests:
+    DIRECTORY = None
+
+    def setUp(self):
+        self.extract = load(self.DIRECTORY, 'radius_attrs').attribute_extractor({
+            'User-Name': None,
+            'User-Password': None,
+            'NAS-IP-Address': '127.0.0.1'
+        })
+
+    def test_values_in_declaration_order(self):
+        p = (('NAS-IP-Address', '10.0.0.1'), ('User-Password', 'secret'), ('User-Name', 'bob'))
+        self.assertEqual(self.extract(p), ('bob', 'secret', '10.0.0.1'))
+
+    def test_missing_attributes_take_defaults(self):
+        self.assertEqual(self.extract((('User-Name', 'bob'),)), ('bob', None, '127.0.0.1'))
+
+    def test_last_occurrence_wins(self):
+        p = (('User-Name', 'bob'), ('Reply-Message', 'x'), ('User-Name', 'alice'))
+        self.assertEqual(self.extract(p)[0], 'alice')
+
+    def test_pairs_with_an_operator(self):
+        p = (('User-Name', ':=', 'bob'), ('User-Name', 'alice', '+='))
+        self.assertEqual(self.extract(p)[0], 'alice')
+
+    def test_pair_map_interface(self):
+        p = PairMap((('User-Name', 'bob'), ('User-Password', 'secret')))
+        self.assertEqual(self.extract(p), ('bob', 'secret', '127.0.0.1'))
+
+
+class RailwayAttributeExtractorTests(AttributeExtractorTests, unittest.TestCase):
+    DIRECTORY = SCRIPTS
+
+
+class ServiceAttributeExtractorTests(AttributeExtractorTests, unittest.TestCase):
+    DIRECTORY = SERVICE_SCRIPTS
+
+
+if __name__ == '__main__':
+    unittest.main()
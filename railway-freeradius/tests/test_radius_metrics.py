@@ -0,0 +1,57 @@
+"""
+Tests for radius_metrics.Metrics, run against both copies
+"""
+
+import gc
+import threading
+import unittest
+
+from support import SCRIPTS, SERVICE_SCRIPTS, load
+
+
+class MetricsTests:
+    DIRECTORY = None
+
+    def setUp(self):
+        self.metrics = load(self.DIRECTORY, 'radius_metrics').Metrics('test')
+
+    def record_in_threads(self, count):
+        def work():
+            self.metrics.observe('backend', 0.002)
+            self.metrics.count('backend', 'ok')
+
+        for _ in range(count):
+            thread = threading.Thread(target=work)
+            thread.start()
+            thread.join()
+        gc.collect()
+
+    def test_exited_threads_retire_their_shards(self):
+        self.record_in_threads(200)
+        self.assertEqual(len(self.metrics.shards), 0)
+
+    def test_retired_counts_are_kept(self):
+        self.metrics.count('backend', 'ok')
+        self.record_in_threads(50)
+        histograms, results, _ = self.metrics.snapshot()
+        self.assertEqual(results[('backend', 'ok')], 51)
+        self.assertEqual(sum(histograms['backend'][:-1]), 50)
+        self.assertIn('result="ok"} 51', self.metrics.render())
+
+    def test_live_thread_keeps_its_shard(self):
+        self.metrics.count('authenticate', 'ok')
+        self.metrics.count('authenticate', 'ok')
+        self.assertEqual(len(self.metrics.shards), 1)
+        self.assertEqual(self.metrics.snapshot()[1][('authenticate', 'ok')], 2)
+
+
+class RailwayMetricsTests(MetricsTests, unittest.TestCase):
+    DIRECTORY = SCRIPTS
+
+
+class ServiceMetricsTests(MetricsTests, unittest.TestCase):
+    DIRECTORY = SERVICE_SCRIPTS
+
+
+if __name__ == '__main__':
+    unittest.main()
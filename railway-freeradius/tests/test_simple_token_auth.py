@@ -0,0 +1,218 @@
+"""
+Tests for the replay and batching guarantees of simple_token_auth
+"""
+
+import gc
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from support import SCRIPTS, load
+
+# RFC 4226 test key, seeded as the demo user, and its first codes
+DEMO_CODES = ('755224', '287082', '359152', '969429')
+
+# RFC 6238 appendix B: keys by digest, and the 8 digit codes at times
+RFC6238_KEYS = {
+    'sha1': b'12345678901234567890'.hex(),
+    'sha256': b'12345678901234567890123456789012'.hex(),
+    'sha512': b'1234567890123456789012345678901234567890123456789012345678901234'.hex()
+}
+RFC6238_CODES = (
+    (59, {'sha1': '94287082', 'sha256': '46119246', 'sha512': '90693936'}),
+    (1111111109, {'sha1': '07081804', 'sha256': '68084774', 'sha512': '25091201'}),
+    (1234567890, {'sha1': '89005924', 'sha256': '91819424', 'sha512': '93441116'}),
+    (2000000000, {'sha1': '69279037', 'sha256': '90698825', 'sha512': '38618901'})
+)
+
+
+class TokenAuthTestCase(unittest.TestCase):
+    MEMORY_TABLE = True
+
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        self.module = self.start()
+
+    def start(self):
+        """Load a fresh copy of the module against the test database"""
+        module = load(SCRIPTS, 'simple_token_auth')
+        module.DB_PATH = os.path.join(self.workdir.name, 'tokens.db')
+        module.MEMORY_TABLE = self.MEMORY_TABLE
+        module.DB_BUSY_TIMEOUT = 0.2
+        self.assertEqual(module.instantiate(None), module.radiusd.RLM_MODULE_OK)
+        self.addCleanup(module.detach, None)
+        return module
+
+    def authenticate(self, module, password, username='demo'):
+        return module.authenticate((('User-Name', username), ('User-Password', password)))
+
+    def enroll(self, username, token_type, secret, digits=None, digest=None):
+        conn = sqlite3.connect(self.module.DB_PATH)
+        try:
+            with conn:
+                conn.execute(
+                    'INSERT INTO tokens (username, token_type, secret, digits, digest) VALUES (?, ?, ?, ?, ?)',
+                    (username, token_type, secret, digits, digest))
+        finally:
+            conn.close()
+
+    def stored_counter(self, username='demo'):
+        conn = sqlite3.connect(self.module.DB_PATH)
+        try:
+            return conn.execute('SELECT counter FROM tokens WHERE username = ?', (username,)).fetchone()[0]
+        finally:
+            conn.close()
+
+    def concurrent(self, func, count):
+        barrier = threading.Barrier(count)
+        results = []
+
+        def run():
+            barrier.wait()
+            results.append(func())
+
+        threads = [threading.Thread(target=run) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+
+class TotpTests(unittest.TestCase):
+
+    def setUp(self):
+        self.module = load(SCRIPTS, 'simple_token_auth')
+
+    def test_rfc6238_vectors(self):
+        for digest, secret in RFC6238_KEYS.items():
+            for now, codes in RFC6238_CODES:
+                with self.subTest(digest=digest, now=now):
+                    token = self.module.TokenEntry('totp', secret, 0, 8, digest, 30, 0)
+                    self.assertEqual(self.module.totp_match('rfc', token, codes[digest], now), now // 30)
+
+    def test_used_step_does_not_match(self):
+        token = self.module.TokenEntry('totp', RFC6238_KEYS['sha1'], 59 // 30 + 1, 8, 'sha1', 30, 0)
+        self.assertIsNone(self.module.totp_match('rfc', token, '94287082', 59))
+
+
+class BadTokenTests:
+
+    def test_totp_accepts_once(self):
+        self.enroll('rfc', 'totp', RFC6238_KEYS['sha256'], 8, 'SHA256')
+        with mock.patch.object(self.module.time, 'time', return_value=1111111109):
+            self.assertEqual(self.authenticate(self.module, '68084774', 'rfc'), self.module.radiusd.RLM_MODULE_OK)
+            self.assertEqual(self.authenticate(self.module, '68084774', 'rfc'), self.module.radiusd.RLM_MODULE_REJECT)
+
+    def test_unsupported_digest_rejects(self):
+        self.enroll('md5', 'totp', RFC6238_KEYS['sha1'], digest='md5')
+        self.assertEqual(self.authenticate(self.module, '123456', 'md5'), self.module.radiusd.RLM_MODULE_REJECT)
+
+    def test_bad_secret_rejects(self):
+        self.enroll('bad', 'hotp', 'not hex')
+        self.assertEqual(self.authenticate(self.module, '123456', 'bad'), self.module.radiusd.RLM_MODULE_REJECT)
+
+
+class TokenTableTests(BadTokenTests, TokenAuthTestCase):
+
+    def test_accept_advances_and_persists_the_counter(self):
+        OK = self.module.radiusd.RLM_MODULE_OK
+        self.assertEqual(self.authenticate(self.module, DEMO_CODES[0]), OK)
+        self.assertEqual(self.module.token_table.entries['demo'].counter, 1)
+        self.assertEqual(self.stored_counter(), 1)
+
+    def test_concurrent_identical_codes_accept_once(self):
+        OK = self.module.radiusd.RLM_MODULE_OK
+        results = self.concurrent(lambda: self.authenticate(self.module, DEMO_CODES[0]), 16)
+        self.assertEqual(results.count(OK), 1)
+        self.assertEqual(self.stored_counter(), 1)
+
+    def test_failed_counter_write_rejects(self):
+        REJECT = self.module.radiusd.RLM_MODULE_REJECT
+        blocker = sqlite3.connect(self.module.DB_PATH, isolation_level=None)
+        blocker.execute('BEGIN EXCLUSIVE')
+        try:
+            self.assertEqual(self.authenticate(self.module, DEMO_CODES[0]), REJECT)
+        finally:
+            blocker.execute('ROLLBACK')
+            blocker.close()
+        self.assertEqual(self.stored_counter(), 0)
+        # The code stays burned in memory, the next one goes through
+        self.assertEqual(self.authenticate(self.module, DEMO_CODES[0]), REJECT)
+        self.assertEqual(self.authenticate(self.module, DEMO_CODES[1]), self.module.radiusd.RLM_MODULE_OK)
+        self.assertEqual(self.stored_counter(), 2)
+
+    def test_replay_after_restart_rejects(self):
+        OK = self.module.radiusd.RLM_MODULE_OK
+        REJECT = self.module.radiusd.RLM_MODULE_REJECT
+        self.assertEqual(self.authenticate(self.module, DEMO_CODES[0]), OK)
+        self.module.detach(None)
+
+        restarted = self.start()
+        self.assertEqual(self.authenticate(restarted, DEMO_CODES[0]), REJECT)
+        self.assertEqual(self.authenticate(restarted, DEMO_CODES[1]), OK)
+
+    def test_queued_advances_share_one_commit(self):
+        writer = self.module.CounterWriter()
+        flushes = [writer.submit(user, 5) for user in ('demo', 'testuser', 'vasco_demo')]
+        flushes.append(writer.submit('demo', 3))
+        writer.start()
+        try:
+            self.assertTrue(all(flush.wait(5) for flush in flushes))
+        finally:
+            writer.stop()
+        self.assertEqual((writer.batches, writer.written), (1, 3))
+        self.assertEqual(self.stored_counter('demo'), 5)
+        self.assertEqual(self.stored_counter('testuser'), 5)
+
+    def test_stop_flushes_pending_advances(self):
+        writer = self.module.CounterWriter(interval=60)
+        writer.start()
+        flush = writer.submit('testuser', 7)
+        writer.stop(timeout=5)
+        self.assertIsNone(writer.thread)
+        self.assertTrue(flush.wait(0))
+        self.assertEqual(self.stored_counter('testuser'), 7)
+
+    def test_submit_after_stop_is_not_acknowledged(self):
+        writer = self.module.CounterWriter()
+        writer.start()
+        writer.stop()
+        self.assertFalse(writer.submit('demo', 1).wait(0))
+
+
+class DatabaseTests(BadTokenTests, TokenAuthTestCase):
+    MEMORY_TABLE = False
+
+    def test_concurrent_identical_codes_accept_once(self):
+        OK = self.module.radiusd.RLM_MODULE_OK
+        results = self.concurrent(lambda: self.authenticate(self.module, DEMO_CODES[0]), 16)
+        self.assertEqual(results.count(OK), 1)
+        self.assertEqual(self.stored_counter(), 1)
+
+    def test_replay_after_restart_rejects(self):
+        OK = self.module.radiusd.RLM_MODULE_OK
+        REJECT = self.module.radiusd.RLM_MODULE_REJECT
+        self.assertEqual(self.authenticate(self.module, DEMO_CODES[0]), OK)
+        self.module.detach(None)
+
+        restarted = self.start()
+        self.assertEqual(self.authenticate(restarted, DEMO_CODES[0]), REJECT)
+        self.assertEqual(self.authenticate(restarted, DEMO_CODES[1]), OK)
+
+    def test_exited_threads_close_their_connections(self):
+        opened = len(self.module.connections)
+        for _ in range(50):
+            thread = threading.Thread(target=self.authenticate, args=(self.module, '000000'))
+            thread.start()
+            thread.join()
+        gc.collect()
+        self.assertEqual(len(self.module.connections), opened)
+
+
+if __name__ == '__main__':
+    unittest.main()
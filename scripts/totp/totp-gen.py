@@ -9,6 +9,11 @@ import struct
 import sys
 import time
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 def hotp(key, counter, digits=6, digest='sha1'):
     key = key.encode('ascii')
     counter = struct.pack('>Q', counter)
@@ -20,6 +25,33 @@ def hotp(key, counter, digits=6, digest='sha1'):
 def totp(key, time_step=30, digits=6, digest='sha1'):
     return hotp(key, int(time.time() / time_step), digits, digest)
 
+#
+#  Codes for counters start .. start + count - 1. The HMACs are computed
+#  in a loop from one keyed state, the dynamic truncation is done on all
+#  of them at once with NumPy when it is installed.
+#
+def hotp_bulk(key, start, count, digits=6, digest='sha1'):
+    keyed = hmac.new(key.encode('ascii'), digestmod = digest)
+    pack = struct.Struct('>Q').pack
+    macs = []
+    for counter in range(start, start + count):
+        mac = keyed.copy()
+        mac.update(pack(counter))
+        macs.append(mac.digest())
+
+    if numpy is None:
+        codes = []
+        for mac in macs:
+            offset = mac[-1] & 0x0f
+            codes.append(struct.unpack('>L', mac[offset:offset+4])[0] & 0x7fffffff)
+    else:
+        matrix = numpy.frombuffer(b''.join(macs), dtype = numpy.uint8).reshape(count, keyed.digest_size)
+        offsets = (matrix[:, -1] & 0x0f).astype(numpy.intp)
+        words = matrix[numpy.arange(count)[:, None], offsets[:, None] + numpy.arange(4)].astype(numpy.uint32)
+        codes = (((words[:, 0] & 0x7f) << 24) | (words[:, 1] << 16) | (words[:, 2] << 8) | words[:, 3]).tolist()
+
+    return [str(code)[-digits:].zfill(digits) for code in codes]
+
 def main():
     parser = argparse.ArgumentParser(description = "Simple TOTP token generator.")
     parser.add_argument("-k", dest = "key", help = "Key in raw format.", required = True)
@@ -27,13 +59,21 @@ def main():
     parser.add_argument("-d", dest = "digits", help = "Length of the one-time password.", default = 6, type = int)
     parser.add_argument("-e", dest = "encode_base32", help = "Encode the output token in base32.", action='store_true')
     parser.add_argument("-D", dest = "digest", help = "HMAC algorithm as described by RFC 2104. default: sha1, options: sha1, sha256, sha512", required = False, default = "sha1")
+    parser.add_argument("-n", dest = "count", help = "Bulk mode: print this many consecutive tokens.", default = 1, type = int)
+    parser.add_argument("-c", dest = "counter", help = "Start at this HOTP counter instead of the current time step.", default = None, type = int)
     args = parser.parse_args()
-    token = totp(args.key, args.time_step, args.digits, args.digest)
 
-    if args.encode_base32:
-        token = base64.b32encode(bytearray(token, 'ascii')).decode('ascii')
+    start = args.counter if args.counter is not None else int(time.time() / args.time_step)
+    if args.count > 1:
+        tokens = hotp_bulk(args.key, start, args.count, args.digits, args.digest)
+    else:
+        tokens = [hotp(args.key, start, args.digits, args.digest)]
+
+    for token in tokens:
+        if args.encode_base32:
+            token = base64.b32encode(bytearray(token, 'ascii')).decode('ascii')
 
-    print(token)
+        print(token)
 
 if __name__ == '__main__':
     main()